@@ -0,0 +1,241 @@
+"""
+End-to-end pipeline benchmark.
+
+Pushes synthetic or pcap-derived packets through the same stages the WebSocket loop runs
+(packet_to_dict -> classify -> count_packets -> record_packet -> optimize_packets -> calculate_statistics -> frame
+serialization) and writes packets/sec and per-batch latency for every stage to JSON.
+
+    cd backend
+    python -m benchmarks.pipeline --sizes 1000,100000,1000000
+    python -m benchmarks.pipeline --pcap dump.pcap --compare benchmarks/results/<old>.json
+"""
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+DEFAULT_BATCH = 1000
+DEFAULT_THRESHOLD = 0.2  # допустимое падение packets/sec относительно базового прогона
+TEMPLATE_COUNT = 512
+
+
+def synthetic_packets(count: int = TEMPLATE_COUNT, seed: int = 0) -> List:
+    """Pool of scapy packets with a realistic mix of TCP, HTTP-ish, UDP and DNS traffic"""
+    from scapy.layers.dns import DNS, DNSQR
+    from scapy.layers.inet import IP, TCP, UDP
+    from scapy.layers.l2 import Ether
+    from scapy.packet import Raw
+
+    rng = random.Random(seed)
+    packets = []
+    for i in range(count):
+        ip = IP(src=f"10.0.{rng.randrange(256)}.{rng.randrange(1, 255)}",
+                dst=f"192.168.{rng.randrange(256)}.{rng.randrange(1, 255)}")
+        kind = i % 4
+        if kind == 0:
+            pkt = Ether() / ip / TCP(sport=rng.randrange(1024, 65535), dport=443, flags="A") / Raw(b"x" * rng.randrange(0, 1400))
+        elif kind == 1:
+            pkt = Ether() / ip / TCP(sport=rng.randrange(1024, 65535), dport=80, flags="PA") / Raw(b"GET / HTTP/1.1\r\n" + b"h" * rng.randrange(0, 600))
+        elif kind == 2:
+            pkt = Ether() / ip / UDP(sport=rng.randrange(1024, 65535), dport=53) / DNS(rd=1, qd=DNSQR(qname="example.com"))
+        else:
+            pkt = Ether() / ip / TCP(sport=rng.randrange(1024, 65535), dport=rng.randrange(1, 1024), flags="S")
+        packets.append(Ether(bytes(pkt)))
+    return packets
+
+
+def pcap_packets(path: str, limit: int) -> List:
+    from scapy.utils import PcapReader
+
+    packets = []
+    with PcapReader(path) as reader:
+        for pkt in reader:
+            packets.append(pkt)
+            if len(packets) >= limit:
+                break
+    if not packets:
+        raise ValueError(f"No packets in {path}")
+    return packets
+
+
+class StageTimer:
+    """Accumulates per-batch durations of one pipeline stage"""
+
+    def __init__(self):
+        self.durations: List[float] = []
+        self.packets = 0
+
+    def run(self, fn: Callable, n_packets: int):
+        started = time.perf_counter()
+        result = fn()
+        self.durations.append(time.perf_counter() - started)
+        self.packets += n_packets
+        return result
+
+    def summary(self) -> Dict:
+        durations = np.array(self.durations)
+        total = float(durations.sum())
+        return {
+            "packets": self.packets,
+            "batches": len(durations),
+            "seconds": total,
+            "packets_per_second": self.packets / total if total > 0 else None,
+            "us_per_packet": total / self.packets * 1e6 if self.packets else None,
+            "batch_p50_ms": float(np.percentile(durations, 50) * 1e3) if durations.size else None,
+            "batch_p95_ms": float(np.percentile(durations, 95) * 1e3) if durations.size else None,
+            "batch_max_ms": float(durations.max() * 1e3) if durations.size else None,
+        }
+
+
+def run_pipeline(pool: List, size: int, batch_size: int = DEFAULT_BATCH) -> Dict[str, Dict]:
+    """Run `size` packets from `pool` (cycled) through every stage and time each one"""
+    from prometheus_client import CollectorRegistry
+    from traffic.metrics import NetworkMetricsCollector
+    from traffic.optimizer import optimize_packets
+    from traffic.classifier import PAYLOAD_PREFIX_BYTES, FlowClassifier
+    from traffic.sniffer import packet_to_dict, payload_prefix
+    from main import build_traffic_frame
+
+    collector = NetworkMetricsCollector(seed=0, registry=CollectorRegistry())
+    classifier = FlowClassifier()
+    timers = {name: StageTimer() for name in
+              ("packet_to_dict", "classify", "count_packets", "record_packet", "optimize_packets", "ws_serialize")}
+    # прогрев: ленивый импорт sklearn не должен попадать в замеры
+    warmup = [d for d in map(packet_to_dict, pool[:50]) if d]
+    optimize_packets(warmup)
+    NetworkMetricsCollector(registry=CollectorRegistry()).calculate_statistics()
+
+    base_time = time.time()
+    metrics = {"statistics": {}, "bandwidth_utilization": {}, "latency_metrics": {}}
+
+    for start in range(0, size, batch_size):
+        n = min(batch_size, size - start)
+        batch = []
+        for i in range(start, start + n):
+            pkt = pool[i % len(pool)]
+            pkt.time = base_time + i * 1e-5  # время захвата по порядку, как у живого трафика
+            batch.append(pkt)
+
+        dicts = timers["packet_to_dict"].run(lambda: [d for d in map(packet_to_dict, batch) if d], n)
+
+        def classify():
+            for pkt, packet in zip(batch, dicts):
+                classifier.classify(packet, lambda: payload_prefix(pkt, PAYLOAD_PREFIX_BYTES))
+        timers["classify"].run(classify, n)
+
+        timers["count_packets"].run(lambda: collector.count_packets(dicts), n)
+
+        timers["record_packet"].run(lambda: collector.record_packets(dicts, optimized=False), n)
+
+        optimized = timers["optimize_packets"].run(lambda: optimize_packets(dicts), n)
+
+        # сериализация как в starlette WebSocket.send_json
+        timers["ws_serialize"].run(lambda: json.dumps(
+            build_traffic_frame(dicts, optimized, metrics), separators=(",", ":"), ensure_ascii=False
+        ), n)
+
+    results = {name: timer.summary() for name, timer in timers.items()}
+
+    # calculate_statistics работает по всей истории, поэтому меряем один вызов на полной истории
+    stats_timer = StageTimer()
+    for _ in range(3):
+        stats_timer.run(collector.calculate_statistics, size)
+    results["calculate_statistics"] = stats_timer.summary()
+    results["calculate_statistics"]["history_packets"] = size
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """List stages whose packets/sec dropped by more than `threshold` against the baseline"""
+    regressions = []
+    for workload, sizes in current["results"].items():
+        for size, stages in sizes.items():
+            for stage, result in stages.items():
+                old = baseline.get("results", {}).get(workload, {}).get(size, {}).get(stage)
+                if not old or not old.get("packets_per_second") or not result.get("packets_per_second"):
+                    continue
+                change = result["packets_per_second"] / old["packets_per_second"] - 1
+                if change < -threshold:
+                    regressions.append(
+                        f"{workload}/{size}/{stage}: {old['packets_per_second']:.0f} -> "
+                        f"{result['packets_per_second']:.0f} pkt/s ({change:+.0%})"
+                    )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Packet pipeline benchmark")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated packet counts")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="packets per processed batch")
+    parser.add_argument("--pcap", help="also run a workload built from this pcap")
+    parser.add_argument("--no-synthetic", action="store_true", help="skip the synthetic workload")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="baseline result file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative drop in packets/sec before failing")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    workloads = {}
+    if not args.no_synthetic:
+        workloads["synthetic"] = synthetic_packets()
+    if args.pcap:
+        workloads["pcap"] = pcap_packets(args.pcap, max(sizes))
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "batch_size": args.batch,
+        "results": {},
+    }
+    for workload, pool in workloads.items():
+        report["results"][workload] = {}
+        for size in sizes:
+            print(f"Running {workload} x {size} packets ...")
+            stages = run_pipeline(pool, size, args.batch)
+            report["results"][workload][str(size)] = stages
+            for stage, result in stages.items():
+                print(f"  {stage:<22} {result['packets_per_second'] or 0:>14,.0f} pkt/s"
+                      f"  p95 batch {result['batch_p95_ms'] or 0:8.2f} ms")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print("Performance regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,13 @@ from models import QoSRuleHistory, SDNFlowRule
 def get_qos_rules(db: Session):
     return db.query(QoSRuleHistory).order_by(QoSRuleHistory.priority.desc()).all()
 
+def get_active_qos_rules(db: Session):
+    """Latest rule per protocol (the table keeps every version)"""
+    rules = {}
+    for rule in db.query(QoSRuleHistory).order_by(QoSRuleHistory.created_at.asc(), QoSRuleHistory.id.asc()):
+        rules[rule.protocol] = rule
+    return list(rules.values())
+
 def create_qos_rule(db: Session, protocol: str, priority: int, bandwidth_bps: int = None):
     db_rule = QoSRuleHistory(
         protocol=protocol,
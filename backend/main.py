@@ -1,17 +1,33 @@
-from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect, Depends
+from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect, Depends, Header
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import threading
-from traffic.sniffer import start_sniffing
+from contextlib import asynccontextmanager
+from traffic.capture import CaptureManager, capture_targets_from_env
+from traffic.engine import EngineSubscriber, engine_authkey, parse_engine_address
 from traffic.optimizer import TrafficOptimizer, optimize_packets
 from traffic.metrics import NetworkMetricsCollector
+from traffic.simulator import (
+    TrafficTrace, TrafficWindow, simulate_rule_sets, DEFAULT_BUFFER_BYTES, DEFAULT_LINK_CAPACITY,
+    MAX_RULE_SETS, MAX_SIMULATION_SPAN
+)
+from traffic.instrumentation import (
+    dropped_packets, monitor_event_loop, stage_duration, track_queue, websocket_clients
+)
+from traffic.anomaly import AnomalyDetector
+from traffic.protocols import stack_id_of
+from traffic.classifier import traffic_class
+from traffic.packetlog import PacketFilter, PacketLogReader, PacketLogWriter
+from traffic.snapshot import join_arrays, read_snapshot, split_arrays, write_snapshot
+from traffic.profiler import ProfilerBusy, collapsed_stacks, memory_diff, sample_stacks
+from functools import partial
+from collections import deque
 import asyncio
-from scapy.layers.inet import IP, TCP, UDP
-from scapy.packet import Packet
+import os
+import secrets
 from typing import Dict, List, Optional, Set
 from datetime import datetime
 from prometheus_client import make_asgi_app
 from pydantic import BaseModel
-from scapy.all import IFACES
 import time
 from sqlalchemy.orm import Session
 from database import get_db, SessionLocal
@@ -29,6 +45,13 @@ class QoSRuleRequest(BaseModel):
     priority: int
     bandwidth_limit: Optional[float] = None
 
+class QoSSimulationRequest(BaseModel):
+    rule_sets: List[List[QoSRule]] = []  # пусто = текущие правила оптимизатора
+    window_seconds: Optional[float] = None
+    pcap_path: Optional[str] = None  # имя файла внутри SIMULATION_PCAP_DIR
+    link_capacity: float = DEFAULT_LINK_CAPACITY  # bytes/s
+    buffer_bytes: float = DEFAULT_BUFFER_BYTES
+
 # SDN Rule Models
 class SDNRuleRequest(BaseModel):
     source_ip: str
@@ -45,7 +68,33 @@ class SDNRuleResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
 
-app = FastAPI(title="Network Traffic Optimization System")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    restore_state_snapshot()
+    await load_qos_rules()
+    start_sniff()
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    snapshotter = asyncio.create_task(snapshot_loop()) if SNAPSHOT_PATH and SNAPSHOT_INTERVAL > 0 else None
+    yield
+    loop_monitor.cancel()
+    if snapshotter is not None:
+        snapshotter.cancel()
+    print("Shutting down server...")
+    for connection in active_connections.copy():
+        try:
+            await connection.close()
+        except Exception as e:
+            print(f"Error closing connection: {e}")
+    active_connections.clear()
+    stop_sniff()
+    if SNAPSHOT_PATH:
+        try:
+            save_state_snapshot()
+        except Exception as e:
+            print(f" Error saving state snapshot: {e}")
+    print(" Server shutdown complete")
+
+app = FastAPI(title="Network Traffic Optimization System", lifespan=lifespan)
 
 metrics_app = make_asgi_app()
 app.mount("/metrics", metrics_app)
@@ -61,11 +110,39 @@ app.add_middleware(
 optimizer = TrafficOptimizer()
 metrics_collector = NetworkMetricsCollector()
 active_connections: Set[WebSocket] = set()
-raw_packets = []
+# пакеты уже в виде dict, их разбирают процессы захвата; без WebSocket-клиентов никто не забирает,
+# поэтому очередь ограничена, а вытесненные старые пакеты считаются в dropped_packets
+MAX_RAW_PACKETS = int(os.getenv("MAX_RAW_PACKETS", "100000"))
+raw_packets = deque(maxlen=MAX_RAW_PACKETS)
+capture_manager: Optional[CaptureManager] = None
+# ENGINE_ADDRESS задан - захват в отдельном процессе (traffic.engine), API только подписывается
+ENGINE_ADDRESS = os.getenv("ENGINE_ADDRESS")
+engine_subscriber: Optional[EngineSubscriber] = None
+# журнал пакетов на диске: пишет процесс захвата (этот или движок), читают все воркеры
+PACKET_LOG_DIR = os.getenv("PACKET_LOG_DIR")
+packet_log_writer: Optional[PacketLogWriter] = None
+packet_log = PacketLogReader(PACKET_LOG_DIR) if PACKET_LOG_DIR else None
+MAX_PACKET_PAGE = 1000
+anomaly_detector = AnomalyDetector()
+traffic_window = TrafficWindow(int(os.getenv("TRAFFIC_WINDOW_PACKETS", "1000000")))
 packet_buffer = []
+
+track_queue("raw_packets", lambda: len(raw_packets))
+track_queue("packet_buffer", lambda: len(packet_buffer))
+track_queue("capture", lambda: capture_manager.queue_depth() if capture_manager else 0)
+websocket_clients.set_function(lambda: len(active_connections))
+# снапшот аналитики для теплого рестарта; пустой SNAPSHOT_PATH отключает
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "traffic_state.snap")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "30"))
+# при восстановлении отбрасываем записи старше этого (от текущего момента), иначе окна растягиваются на простой
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "600"))
+restored_capture: Optional[Dict] = None
 last_send_time = time.time()
 SEND_INTERVAL = 2.0
 MAX_PACKETS_PER_BATCH = 50
+# pcap для /api/qos/simulate читаются только из этого каталога
+SIMULATION_PCAP_DIR = os.getenv("SIMULATION_PCAP_DIR")
+MAX_PCAP_PACKETS = 1_000_000
 
 # QoS Endpoints
 @app.get("/api/qos/rules", response_model=List[QoSRule])
@@ -89,6 +166,7 @@ async def set_qos_rule(rule: QoSRuleRequest, db: Session = Depends(get_db)):
             priority=rule.priority,
             bandwidth_limit=rule.bandwidth_limit
         )
+        broadcast_qos_rules()
         return {
             "message": f"QoS rule set for {rule.protocol}",
             "status": "success",
@@ -110,6 +188,7 @@ async def delete_qos_rule(protocol: str, db: Session = Depends(get_db)):
             print(f" No rule found for {protocol}")
             raise HTTPException(status_code=404, detail=f"No rule found for {protocol}")
         optimizer.remove_qos_rule(protocol)
+        broadcast_qos_rules()
         print(f"✅ Rule deleted from database and optimizer")
         return {"message": f"QoS rule deleted for {protocol}", "status": "success"}
     except HTTPException:
@@ -118,6 +197,59 @@ async def delete_qos_rule(protocol: str, db: Session = Depends(get_db)):
         print(f" Error deleting QoS rule: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def simulation_pcap(name: str) -> str:
+    """Path of a pcap inside SIMULATION_PCAP_DIR; anything else is rejected"""
+    if not SIMULATION_PCAP_DIR:
+        raise HTTPException(status_code=400, detail="pcap replay is disabled (SIMULATION_PCAP_DIR)")
+    base = os.path.realpath(SIMULATION_PCAP_DIR)
+    path = os.path.realpath(os.path.join(base, name))
+    if os.path.commonpath([base, path]) != base or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"No pcap {name} in SIMULATION_PCAP_DIR")
+    return path
+
+@app.post("/api/qos/simulate")
+async def simulate_qos_rules(request: QoSSimulationRequest):
+    """Replay recorded traffic (or a pcap from SIMULATION_PCAP_DIR) against candidate QoS rule sets"""
+    if len(request.rule_sets) > MAX_RULE_SETS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_RULE_SETS} rule sets per simulation")
+    if request.link_capacity <= 0 or request.buffer_bytes <= 0:
+        raise HTTPException(status_code=400, detail="link_capacity and buffer_bytes must be positive")
+    if request.rule_sets:
+        rule_sets = [
+            {r.protocol: {"priority": r.priority, "bandwidth_limit": r.bandwidth_limit} for r in rules}
+            for rules in request.rule_sets
+        ]
+    else:
+        rule_sets = [dict(optimizer.get_all_qos_rules())]
+    loop = asyncio.get_running_loop()
+    try:
+        if request.pcap_path:
+            trace = await loop.run_in_executor(
+                None, partial(TrafficTrace.from_pcap, simulation_pcap(request.pcap_path), limit=MAX_PCAP_PACKETS)
+            )
+        else:
+            # копия окна и сборка массивов на 1M пакетов - сотни мс, не держим event loop
+            trace = await loop.run_in_executor(None, traffic_window.trace, request.window_seconds)
+        if len(trace) == 0:
+            raise HTTPException(status_code=400, detail="No traffic to simulate")
+        if trace.duration > MAX_SIMULATION_SPAN:
+            raise HTTPException(status_code=400, detail=f"Trace spans {trace.duration:.0f}s, "
+                                                        f"at most {MAX_SIMULATION_SPAN}s can be simulated")
+        results = await loop.run_in_executor(None, partial(
+            simulate_rule_sets, trace, rule_sets,
+            link_capacity=request.link_capacity, buffer_bytes=request.buffer_bytes
+        ))
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f" Error simulating QoS rules: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "packets": len(trace),
+        "duration": trace.duration,
+        "results": [{"rules": rules, **result} for rules, result in zip(rule_sets, results)],
+    }
+
 # SDN Endpoints
 @app.get("/api/sdn/rules", response_model=List[SDNRuleResponse])
 async def get_sdn_rules(db: Session = Depends(get_db)):
@@ -152,6 +284,11 @@ async def get_current_metrics():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/anomalies")
+async def get_anomalies(since: int = 0):
+    """Recent anomaly events (bursts, SYN floods, port scans) with id greater than `since`"""
+    return anomaly_detector.events_since(since)
+
 @app.post("/api/metrics/clear")
 async def clear_metrics_history():
     try:
@@ -160,41 +297,101 @@ async def clear_metrics_history():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def packet_to_dict(pkt: Packet) -> dict:
-    """Convert Scapy packet to dictionary format"""
+@app.get("/api/capture/stats")
+async def get_capture_stats():
+    """Per-worker and merged capture totals"""
+    if engine_subscriber is not None:
+        return {**engine_subscriber.aggregates, "engine_connected": engine_subscriber.connected}
+    if capture_manager is None:
+        return {"workers": {}, "protocols": {}, "total_packets": 0}
+    return capture_manager.get_aggregates()
+
+@app.get("/api/packets")
+async def get_packets(cursor: Optional[int] = None, filter: str = "", limit: int = 100):
+    """
+    Logged packets, newest first. Pass `next_cursor` from the previous page as `cursor`;
+    `filter` is a space-separated list of key=value terms (see PacketFilter).
+    """
+    if packet_log is None:
+        raise HTTPException(status_code=503, detail="Packet log is disabled (PACKET_LOG_DIR)")
+    if not 0 < limit <= MAX_PACKET_PAGE:
+        raise HTTPException(status_code=400, detail=f"limit must be in (0, {MAX_PACKET_PAGE}]")
     try:
-        layers = []
-        current = pkt
-        while current:
-            layers.append(current.name)
-            current = current.payload
-
-        packet_dict = {
-            "src": pkt[IP].src if IP in pkt else None,
-            "dst": pkt[IP].dst if IP in pkt else None,
-            "protocols": layers,
-            "length": len(pkt),
-            "timestamp": datetime.now().isoformat(),
-            "summary": pkt.summary()
-        }
-
-        if TCP in pkt:
-            packet_dict["tcp_info"] = {
-                "sport": pkt[TCP].sport,
-                "dport": pkt[TCP].dport,
-                "flags": str(pkt[TCP].flags),
-                "window": pkt[TCP].window
-            }
-        if UDP in pkt:
-            packet_dict["udp_info"] = {
-                "sport": pkt[UDP].sport,
-                "dport": pkt[UDP].dport,
-                "len": pkt[UDP].len
+        packet_filter = PacketFilter.parse(filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    started = time.perf_counter()
+    packets, next_cursor = await asyncio.get_running_loop().run_in_executor(
+        None, partial(packet_log.query, packet_filter, cursor, limit)
+    )
+    stage_duration.labels(stage="packet_log_query").observe(time.perf_counter() - started)
+    return {"packets": packets, "next_cursor": next_cursor}
+
+# Admin / diagnostics
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Diagnostics endpoints are disabled unless ADMIN_TOKEN is set and sent in the X-Admin-Token header"""
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(status_code=404, detail="Diagnostics are disabled (ADMIN_TOKEN is not set)")
+    if not secrets.compare_digest(x_admin_token or "", token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/api/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def profile_cpu(seconds: float = 10.0, interval: float = 0.005, include_idle: bool = False):
+    """Sample all threads for N seconds; returns collapsed stacks for flamegraph.pl / speedscope"""
+    if not 0 < seconds <= 120 or not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="seconds must be in (0, 120], interval in [0.001, 1]")
+    try:
+        samples = await asyncio.get_running_loop().run_in_executor(
+            None, partial(sample_stacks, seconds, interval, include_idle)
+        )
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return collapsed_stacks(samples)
+
+@app.get("/api/admin/memory", dependencies=[Depends(require_admin)])
+async def profile_memory(seconds: float = 10.0, top: int = 25, frames: int = 1):
+    """tracemalloc diff over N seconds plus sizes of the in-memory packet buffers"""
+    if not 0 < seconds <= 300 or not 1 <= top <= 1000 or not 1 <= frames <= 100:
+        raise HTTPException(status_code=400, detail="seconds must be in (0, 300], top in [1, 1000], frames in [1, 100]")
+    try:
+        growth = await asyncio.get_running_loop().run_in_executor(
+            None, partial(memory_diff, seconds, top, frames)
+        )
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {
+        "top_growth": growth,
+        "buffers": {
+            "raw_packets": len(raw_packets),
+            "packet_buffer": len(packet_buffer),
+            "traffic_window": len(traffic_window.records),
+            "metrics_history": {k: len(v) for k, v in metrics_collector.metrics_history.items()},
+            "optimized_history": {k: len(v) for k, v in metrics_collector.optimized_history.items()},
+        },
+    }
+
+def build_traffic_frame(packet_dicts: List[Dict], optimized_packets: List[Dict], metrics: Dict) -> Dict:
+    """WebSocket frame for a processed batch: packets, metrics and per-protocol aggregation"""
+    protocol_aggregation = {}
+    for pkt in packet_dicts:
+        protocol = traffic_class(pkt)
+        if protocol not in protocol_aggregation:
+            protocol_aggregation[protocol] = {
+                "count": 0,
+                "total_size": 0,
+                "packets": []
             }
-        return packet_dict
-    except Exception as e:
-        print(f" Error converting packet: {e}")
-        return None
+        protocol_aggregation[protocol]["count"] += 1
+        protocol_aggregation[protocol]["total_size"] += pkt.get("length", 0)
+        protocol_aggregation[protocol]["packets"].append(pkt)
+
+    return {
+        "packets": optimized_packets[-MAX_PACKETS_PER_BATCH:],
+        "metrics": metrics,
+        "aggregation": protocol_aggregation,
+        "timestamp": datetime.now().isoformat()
+    }
 
 @app.websocket("/ws/traffic")
 async def traffic_ws(websocket: WebSocket):
@@ -202,6 +399,7 @@ async def traffic_ws(websocket: WebSocket):
     await websocket.accept()
     active_connections.add(websocket)
     print(f"📡 WebSocket client connected: {websocket.client}")
+    last_anomaly_id = 0
 
     try:
         while True:
@@ -209,46 +407,35 @@ async def traffic_ws(websocket: WebSocket):
             try:
                 global last_send_time
                 now = time.time()
-                if raw_packets:
-                    packet_buffer.extend(raw_packets)
-                    raw_packets.clear()
+                # забираем поштучно: поток захвата может дописывать в это время, extend + clear потерял бы пакеты
+                for _ in range(len(raw_packets)):
+                    packet_buffer.append(raw_packets.popleft())
 
                 if now - last_send_time >= SEND_INTERVAL and packet_buffer:
                     print(f"⚙️ Processing {len(packet_buffer)} packets (batch) ...")
 
-                    packets_to_process = packet_buffer[-MAX_PACKETS_PER_BATCH:]
-                    packet_dicts = [packet_to_dict(pkt) for pkt in packets_to_process]
-                    packet_dicts = [pkt for pkt in packet_dicts if pkt]
+                    packet_dicts = packet_buffer[-MAX_PACKETS_PER_BATCH:]
+                    if len(packet_buffer) > MAX_PACKETS_PER_BATCH:
+                        dropped_packets.labels(reason="batch_truncated").inc(len(packet_buffer) - MAX_PACKETS_PER_BATCH)
 
-                    for packet in packet_dicts:
-                        metrics_collector.record_packet(packet, optimized=False)
+                    started = time.perf_counter()
+                    metrics_collector.record_packets(packet_dicts, optimized=False)
+                    metrics_seconds = time.perf_counter() - started
 
-                    optimized_packets = optimize_packets(packet_dicts)
-                    for packet in optimized_packets:
-                        metrics_collector.record_packet(packet, optimized=True)
+                    with stage_duration.labels(stage="optimizer").time():
+                        optimized_packets = optimize_packets(packet_dicts, optimizer)
 
+                    started = time.perf_counter()
+                    metrics_collector.record_packets(optimized_packets, optimized=True)
                     metrics = await get_current_metrics()
-
-                    protocol_aggregation = {}
-                    for pkt in packet_dicts:
-                        protocol = pkt.get("protocols", ["Unknown"])[0]
-                        if protocol not in protocol_aggregation:
-                            protocol_aggregation[protocol] = {
-                                "count": 0,
-                                "total_size": 0,
-                                "packets": []
-                            }
-                        protocol_aggregation[protocol]["count"] += 1
-                        protocol_aggregation[protocol]["total_size"] += pkt.get("length", 0)
-                        protocol_aggregation[protocol]["packets"].append(pkt)
-
-                    response = {
-                        "packets": optimized_packets[-MAX_PACKETS_PER_BATCH:],
-                        "metrics": metrics,
-                        "aggregation": protocol_aggregation,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    await websocket.send_json(response)
+                    stage_duration.labels(stage="metrics").observe(metrics_seconds + time.perf_counter() - started)
+
+                    response = build_traffic_frame(packet_dicts, optimized_packets, metrics)
+                    response["anomalies"] = anomaly_detector.events_since(last_anomaly_id)
+                    with stage_duration.labels(stage="websocket_send").time():
+                        await websocket.send_json(response)
+                    if response["anomalies"]:
+                        last_anomaly_id = response["anomalies"][-1]["id"]
                     packet_buffer.clear()
                     last_send_time = now
                 else:
@@ -256,9 +443,13 @@ async def traffic_ws(websocket: WebSocket):
                     response = {
                         "packets": [],
                         "metrics": metrics,
+                        "anomalies": anomaly_detector.events_since(last_anomaly_id),
                         "timestamp": datetime.now().isoformat()
                     }
-                    await websocket.send_json(response)
+                    with stage_duration.labels(stage="websocket_send").time():
+                        await websocket.send_json(response)
+                    if response["anomalies"]:
+                        last_anomaly_id = response["anomalies"][-1]["id"]
             except WebSocketDisconnect:
                 print(f"Client disconnected normally: {websocket.client}")
                 break
@@ -269,18 +460,8 @@ async def traffic_ws(websocket: WebSocket):
         active_connections.discard(websocket)
         print(f" Client disconnected: {websocket.client}")
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    print("Shutting down server...")
-    for connection in active_connections.copy():
-        try:
-            await connection.close()
-        except Exception as e:
-            print(f"Error closing connection: {e}")
-    active_connections.clear()
-    print(" Server shutdown complete")
-
 def choose_interface():
+    from scapy.all import IFACES
     print("Available network interfaces:")
     iface_list = []
     for i, iface in enumerate(IFACES.values()):
@@ -296,20 +477,149 @@ def choose_interface():
         except Exception as e:
             print(f"Invalid input: {e}")
 
+def snapshot_components():
+    return {"metrics": metrics_collector, "window": traffic_window, "anomaly": anomaly_detector}
+
+def save_state_snapshot():
+    """Write histories, traffic window, anomaly baselines, capture totals and QoS rules to SNAPSHOT_PATH"""
+    started = time.perf_counter()
+    sections, arrays = {}, {}
+    for name, component in snapshot_components().items():
+        sections[name], component_arrays = component.export_state()
+        arrays.update(join_arrays(name, component_arrays))
+    sections["qos_rules"] = dict(optimizer.get_all_qos_rules())
+    if capture_manager is not None:
+        sections["capture"] = capture_manager.get_aggregates()
+    elif restored_capture is not None:
+        sections["capture"] = restored_capture
+    write_snapshot(SNAPSHOT_PATH, sections, arrays)
+    stage_duration.labels(stage="snapshot").observe(time.perf_counter() - started)
+
+def restore_state_snapshot():
+    """Load the last snapshot (if any) into the in-memory state"""
+    global restored_capture
+    if not SNAPSHOT_PATH:
+        return
+    started = time.perf_counter()
+    try:
+        snapshot = read_snapshot(SNAPSHOT_PATH)
+        if snapshot is None:
+            return
+        header, arrays = snapshot
+        sections = header["sections"]
+        since = time.time() - SNAPSHOT_MAX_AGE
+        for name, component in snapshot_components().items():
+            if name in sections:
+                component.restore_state(sections[name], split_arrays(arrays, name), since=since)
+        optimizer.load_qos_rules(sections.get("qos_rules", {}))
+        restored_capture = sections.get("capture")
+    except Exception as e:
+        print(f" Error restoring state snapshot {SNAPSHOT_PATH}: {e}")
+        return
+    age = time.time() - header["created_at"]
+    print(f" Restored state snapshot ({len(metrics_collector.metrics_history['packet_sizes'])} packets, "
+          f"{age:.0f}s old) in {time.perf_counter() - started:.2f}s")
+
+def _fetch_qos_rules() -> Dict[str, Dict]:
+    db = SessionLocal()
+    try:
+        return {
+            r.protocol: {"priority": r.priority, "bandwidth_limit": r.bandwidth_bps}
+            for r in crud.get_active_qos_rules(db)
+        }
+    finally:
+        db.close()
+
+async def load_qos_rules(timeout: float = 5.0):
+    """Load QoS rules from the database into the optimizer; the database wins over the snapshot"""
+    try:
+        rules = await asyncio.wait_for(asyncio.to_thread(_fetch_qos_rules), timeout)
+    except Exception as e:
+        print(f" Could not load QoS rules from database, keeping {len(optimizer.qos_rules)} current rules: {e!r}")
+        return
+    optimizer.load_qos_rules(rules)
+    print(f" Loaded {len(rules)} QoS rules from database")
+
+async def snapshot_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            # сериализация и запись в отдельном потоке, event loop не блокируется
+            await loop.run_in_executor(None, save_state_snapshot)
+        except Exception as e:
+            print(f" Error saving state snapshot: {e}")
+
+def broadcast_qos_rules():
+    """Tell the other API workers (through the capture engine) that QoS rules changed in the database"""
+    if engine_subscriber is not None:
+        engine_subscriber.publish("qos_rules_changed", None)
+
+def packets_callback(packets):
+    for packet in packets:
+        stack_id_of(packet)
+    # счетчики Prometheus - здесь: WebSocket-цикл видит только выборку и только при подключенном клиенте
+    metrics_collector.count_packets(packets)
+    if packet_log_writer is not None:
+        try:
+            packet_log_writer.append(packets)
+        except Exception as e:
+            print(f" Error writing packet log: {e}")
+    overflow = len(raw_packets) + len(packets) - MAX_RAW_PACKETS
+    if overflow > 0:
+        dropped_packets.labels(reason="raw_backlog").inc(overflow)
+    raw_packets.extend(packets)
+    traffic_window.add_packets(packets)
+    anomaly_detector.observe_batch(packets)
+
 def start_sniff():
-    print(" Starting network sniffer...")
-    def packet_callback(pkt):
-        print(f" Captured packet: {pkt.summary()}")
-        raw_packets.append(pkt)
+    """Start capture workers for the configured sources, or subscribe to the capture engine"""
+    global capture_manager, engine_subscriber, packet_log_writer
+    if ENGINE_ADDRESS:
+        address = parse_engine_address(ENGINE_ADDRESS)
+        print(f" Subscribing to capture engine at {address}")
+        loop = asyncio.get_running_loop()
+
+        def reload_qos_rules(_=None):
+            # из потока подписчика: перечитываем правила из БД и применяем их в event loop
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(load_qos_rules()))
+
+        engine_subscriber = EngineSubscriber(address, {
+            "packets": packets_callback,
+            "qos_rules_changed": reload_qos_rules,
+        }, authkey=engine_authkey(address), on_connect=reload_qos_rules)
+        engine_subscriber.start()
+        return
+    targets = capture_targets_from_env()
+    if not targets:
+        print(" Capture is not configured (CAPTURE_INTERFACES / CAPTURE_PCAP), sniffer disabled")
+        return
+    print(f" Starting network sniffer on: {targets}")
+    if PACKET_LOG_DIR:
+        packet_log_writer = PacketLogWriter(PACKET_LOG_DIR)
     try:
-        interface = choose_interface()
-        print(f"Using interface: {interface}")
-        start_sniffing(packet_callback, interface=interface)
+        capture_manager = CaptureManager(targets, packets_callback)
+        if restored_capture is not None:
+            capture_manager.restore_aggregates(restored_capture)
+        capture_manager.start()
     except Exception as e:
         print(f" Sniffer error: {e}")
 
-threading.Thread(target=start_sniff, daemon=True).start()
+def stop_sniff():
+    global capture_manager, engine_subscriber, packet_log_writer
+    if engine_subscriber is not None:
+        engine_subscriber.stop()
+        engine_subscriber = None
+    if capture_manager is not None:
+        capture_manager.stop()
+        capture_manager = None
+    if packet_log_writer is not None:
+        packet_log_writer.close()
+        packet_log_writer = None
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
+    if sys.stdin.isatty() and not capture_targets_from_env():
+        os.environ["CAPTURE_INTERFACES"] = choose_interface()
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,35 @@
+import time
+
+from traffic.anomaly import AnomalyDetector
+
+
+def _syn(src, dst, sport, dport, flags="S"):
+    return {"src": src, "dst": dst, "protocols": ["Ethernet", "IP", "TCP"],
+            "tcp_info": {"sport": sport, "dport": dport, "flags": flags}}
+
+
+def _run(packets):
+    """One detector interval containing `packets`"""
+    detector = AnomalyDetector()
+    return detector.observe_batch(packets, now=time.time() + detector.interval)
+
+
+def test_server_answering_many_clients_is_not_a_scan():
+    # SYN-ACK сервера 150 разным клиентам
+    replies = [_syn("10.0.0.1", f"10.0.1.{i % 250}", 443, 40000 + i, flags="SA") for i in range(150)]
+    assert [e for e in _run(replies) if e["type"] == "port_scan"] == []
+
+
+def test_port_scan():
+    probes = [_syn("10.0.0.66", "10.0.0.1", 55555, port) for port in range(1, 151)]
+    events = [e for e in _run(probes) if e["type"] == "port_scan"]
+    assert len(events) == 1
+    assert events[0]["src"] == "10.0.0.66"
+    assert events[0]["distinct_ports"] >= 100
+
+
+def test_syn_flood():
+    flood = [_syn(f"10.9.{i // 250}.{i % 250}", "10.0.0.1", 1024 + i, 80) for i in range(500)]
+    events = [e for e in _run(flood) if e["type"] == "syn_flood"]
+    assert len(events) == 1
+    assert events[0]["dst"] == "10.0.0.1"
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("scapy")
+
+from scapy.layers.inet import IP, TCP
+from scapy.layers.l2 import Ether
+from scapy.packet import Padding, Raw
+
+from traffic.classifier import PAYLOAD_PREFIX_BYTES, FlowClassifier, traffic_class
+from traffic.sniffer import packet_to_dict, payload_prefix
+
+
+def _captured(pkt):
+    """Packet as it comes off the wire (re-dissected from bytes)"""
+    return Ether(bytes(pkt))
+
+
+def _classify(classifier, pkt):
+    packet = packet_to_dict(pkt)
+    classifier.classify(packet, lambda: payload_prefix(pkt, PAYLOAD_PREFIX_BYTES))
+    return packet
+
+
+def test_padded_ack_does_not_finalize_flow():
+    ip = IP(src="10.0.0.1", dst="10.0.0.2")
+    # голый ACK короче минимального кадра Ethernet - добит нулями
+    ack = _captured(Ether() / ip / TCP(sport=50000, dport=8443, flags="A") / Padding(b"\x00" * 6))
+    request = _captured(Ether() / ip / TCP(sport=50000, dport=8443, flags="PA") / Raw(b"GET / HTTP/1.1\r\n\r\n"))
+    assert Padding in ack and payload_prefix(ack, PAYLOAD_PREFIX_BYTES) == b""
+
+    classifier = FlowClassifier()
+    assert traffic_class(_classify(classifier, ack)) == "TLS"  # пока только по порту
+    packet = _classify(classifier, request)
+    assert packet["app_protocol"] == "HTTP"
+    assert "HTTP" in packet["protocols"]
+
+
+def test_flow_is_finalized_by_first_payload():
+    ip = IP(src="10.0.0.1", dst="10.0.0.2")
+    classifier = FlowClassifier()
+    _classify(classifier, _captured(Ether() / ip / TCP(sport=50001, dport=80, flags="PA") / Raw(b"\x16\x03\x01\x00")))
+    later = _classify(classifier, _captured(Ether() / ip / TCP(sport=50001, dport=80, flags="PA") / Raw(b"GET / HTTP/1.1")))
+    assert later["app_protocol"] == "TLS"
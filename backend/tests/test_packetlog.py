@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+
+from traffic.packetlog import BLOCK_RECORDS, PacketFilter, PacketLogReader, PacketLogWriter, list_segments
+
+BASE_TIME = 1_700_000_000.0
+HOSTS = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "2001:db8::1"]
+# два полных блока и неполный в каждом сегменте
+SEGMENT_RECORDS = 2 * BLOCK_RECORDS + 500
+
+
+def _packet(seq):
+    # 10.0.0.99 встречается только в первом блоке: остальные блоки отсекает bloom-фильтр
+    src = "10.0.0.99" if seq < 10 else HOSTS[seq % len(HOSTS)]
+    packet = {
+        "timestamp": datetime.fromtimestamp(BASE_TIME + seq * 0.01).isoformat(),
+        "src": src, "dst": "192.168.1.1", "length": 60 + seq % 1400,
+    }
+    if seq % 3:
+        packet["protocols"] = ["Ethernet", "IP", "TCP"]
+        packet["tcp_info"] = {"sport": 1024 + seq % 5000, "dport": 443, "flags": "A"}
+    else:
+        packet["protocols"] = ["Ethernet", "IP", "UDP", "DNS"]
+        packet["udp_info"] = {"sport": 1024 + seq % 5000, "dport": 53}
+    return packet
+
+
+@pytest.fixture
+def log(tmp_path):
+    """Three segments; the writer stays open, so the last block of the newest one is unindexed"""
+    writer = PacketLogWriter(str(tmp_path), segment_records=SEGMENT_RECORDS)
+    total = 2 * SEGMENT_RECORDS + BLOCK_RECORDS + 123
+    packets = [_packet(seq) for seq in range(total)]
+    for seq in range(0, total, 3000):
+        writer.append(packets[seq:seq + 3000])
+    assert len(list_segments(str(tmp_path))) == 3
+    yield writer, PacketLogReader(str(tmp_path)), packets
+    writer.close()
+
+
+def _walk(reader, text, limit):
+    packet_filter = PacketFilter.parse(text)
+    ids, cursor = [], None
+    while True:
+        page, cursor = reader.query(packet_filter, cursor=cursor, limit=limit)
+        assert len(page) <= limit
+        ids.extend(p["id"] for p in page)
+        if cursor is None:
+            return ids
+
+
+def _expected(packets, predicate):
+    return [seq for seq in range(len(packets) - 1, -1, -1) if predicate(packets[seq])]
+
+
+@pytest.mark.parametrize("limit", [1000, 4096, 7777])
+def test_cursor_walk_returns_every_record_once_newest_first(log, limit):
+    _, reader, packets = log
+    assert _walk(reader, "", limit) == list(range(len(packets) - 1, -1, -1))
+
+
+@pytest.mark.parametrize("text, predicate", [
+    ("src=10.0.0.2", lambda p: p["src"] == "10.0.0.2"),
+    ("src=10.0.0.99", lambda p: p["src"] == "10.0.0.99"),
+    ("host=2001:db8::1 protocol=DNS", lambda p: p["src"] == "2001:db8::1" and "DNS" in p["protocols"]),
+    (f"since={BASE_TIME + 50} until={BASE_TIME + 120}",
+     lambda p: BASE_TIME + 50 <= datetime.fromisoformat(p["timestamp"]).timestamp() <= BASE_TIME + 120),
+    ("dport=443 src=10.0.0.77", lambda p: False),
+])
+def test_filtered_walk_matches_full_scan(log, text, predicate):
+    _, reader, packets = log
+    assert _walk(reader, text, 500) == _expected(packets, predicate)
+
+
+def test_page_contents(log):
+    _, reader, packets = log
+    page, cursor = reader.query(PacketFilter.parse("transport=tcp"), limit=3)
+    seq = page[0]["id"]
+    assert [p["id"] for p in page] == _expected(packets, lambda p: "tcp_info" in p)[:3]
+    assert cursor == page[-1]["id"]
+    assert page[0]["src"] == packets[seq]["src"]
+    assert page[0]["protocols"] == packets[seq]["protocols"]
+    assert page[0]["dport"] == 443 and page[0]["flags"] == "A"
+
+
+def test_retention_during_walk(log):
+    writer, reader, packets = log
+    packet_filter = PacketFilter.parse("")
+    page, cursor = reader.query(packet_filter, limit=100)
+    ids = [p["id"] for p in page]
+
+    # новый сегмент посреди обхода вытесняет два самых старых
+    writer.max_segments = 2
+    writer.append([_packet(seq) for seq in range(len(packets), len(packets) + SEGMENT_RECORDS)])
+    assert list_segments(reader.directory)[0] == 2 * SEGMENT_RECORDS
+
+    while cursor is not None:
+        page, cursor = reader.query(packet_filter, cursor=cursor, limit=1000)
+        ids.extend(p["id"] for p in page)
+    # дописанное после первой страницы не возвращается, удаленные сегменты пропускаются без ошибок
+    assert ids == list(range(len(packets) - 1, 2 * SEGMENT_RECORDS - 1, -1))
@@ -0,0 +1,188 @@
+from typing import Dict, List, Optional, Tuple
+from collections import defaultdict, deque
+import math
+import threading
+import time
+from datetime import datetime
+
+from prometheus_client import Counter
+
+anomaly_events = Counter('network_anomaly_events_total', 'Anomalies detected on the traffic stream', ['type'])
+
+
+class EwmaDetector:
+    """
+    Exponentially weighted mean/variance of a rate. `update` is O(1) and returns the z-score
+    of the new value against the history before it (None while warming up).
+    """
+
+    def __init__(self, alpha: float = 0.1, warmup: int = 10, min_std: float = 1.0):
+        self.alpha = alpha
+        self.warmup = warmup
+        self.min_std = min_std
+        self.mean = 0.0
+        self.var = 0.0
+        self.samples = 0
+
+    def update(self, value: float) -> Optional[float]:
+        z = None
+        if self.samples >= self.warmup:
+            # нижняя граница std, чтобы идеально ровный поток не давал бесконечный z
+            z = (value - self.mean) / max(math.sqrt(self.var), self.min_std)
+        if self.samples == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.samples += 1
+        return z
+
+
+class AnomalyDetector:
+    """
+    Streaming burst, SYN-flood and port-scan detection over packet dicts from packet_to_dict.
+
+    Packets only update counters (a few dict increments each); detectors run once per `interval`
+    seconds on the aggregated counts, so the cost per evaluation does not depend on traffic volume.
+    """
+
+    def __init__(self, interval: float = 1.0, z_threshold: float = 4.0, min_rate: float = 10.0,
+                 syn_rate_threshold: float = 100.0, syn_ratio_threshold: float = 3.0,
+                 scan_ports_threshold: int = 100, scan_window: float = 10.0,
+                 max_tracked: int = 10000, cooldown: float = 30.0, max_events: int = 1000):
+        self.interval = interval
+        self.z_threshold = z_threshold
+        self.min_rate = min_rate
+        self.syn_rate_threshold = syn_rate_threshold
+        self.syn_ratio_threshold = syn_ratio_threshold
+        self.scan_ports_threshold = scan_ports_threshold
+        self.scan_window = scan_window
+        self.max_tracked = max_tracked
+        self.cooldown = cooldown
+
+        self.rates: Dict[str, EwmaDetector] = {}
+        self._protocol_counts = defaultdict(int)
+        self._syn_by_dst = defaultdict(int)      # SYN без ACK по адресу назначения
+        self._synack_by_src = defaultdict(int)   # SYN-ACK от сервера
+        self._scan_ports: Dict[str, set] = {}    # src -> {(dst, dport)} в текущем окне
+        self._scan_window_start = time.time()
+        self._last_tick = time.time()
+        self._last_fired: Dict[Tuple[str, str], float] = {}
+
+        self.events = deque(maxlen=max_events)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def observe_batch(self, packets: List[Dict], now: Optional[float] = None) -> List[Dict]:
+        """Count a batch of packets; runs the detectors if `interval` has passed. Returns new events."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for packet in packets:
+                for protocol in packet.get("protocols", ()):
+                    self._protocol_counts[protocol] += 1
+                tcp = packet.get("tcp_info")
+                if tcp is None:
+                    continue
+                flags = tcp.get("flags", "")
+                if "S" in flags:
+                    if "A" in flags:
+                        # ответ сервера: в скан не считаем, иначе сервер с сотней клиентов - "сканер"
+                        self._synack_by_src[packet.get("src")] += 1
+                        continue
+                    if len(self._syn_by_dst) < self.max_tracked or packet.get("dst") in self._syn_by_dst:
+                        self._syn_by_dst[packet.get("dst")] += 1
+                    src = packet.get("src")
+                    ports = self._scan_ports.get(src)
+                    if ports is None:
+                        if len(self._scan_ports) >= self.max_tracked:
+                            continue
+                        ports = self._scan_ports[src] = set()
+                    if len(ports) <= self.scan_ports_threshold:
+                        ports.add((packet.get("dst"), tcp.get("dport")))
+
+            if now - self._last_tick < self.interval:
+                return []
+            return self._evaluate(now)
+
+    def _evaluate(self, now: float) -> List[Dict]:
+        elapsed = max(now - self._last_tick, 1e-6)
+        self._last_tick = now
+        events = []
+
+        for protocol, count in self._protocol_counts.items():
+            detector = self.rates.get(protocol)
+            if detector is None:
+                if len(self.rates) >= self.max_tracked:
+                    continue
+                detector = self.rates[protocol] = EwmaDetector()
+            rate = count / elapsed
+            z = detector.update(rate)
+            if z is not None and z >= self.z_threshold and rate >= self.min_rate:
+                events.append(self._event("burst", now, protocol=protocol, rate=rate, z_score=z,
+                                          expected_rate=detector.mean))
+        # протоколы без пакетов в этом интервале тоже обновляем нулем
+        for protocol, detector in self.rates.items():
+            if protocol not in self._protocol_counts:
+                detector.update(0.0)
+        self._protocol_counts.clear()
+
+        for dst, syn_count in self._syn_by_dst.items():
+            syn_rate = syn_count / elapsed
+            ratio = syn_count / (self._synack_by_src.get(dst, 0) + 1)
+            if syn_rate >= self.syn_rate_threshold and ratio >= self.syn_ratio_threshold:
+                events.append(self._event("syn_flood", now, dst=dst, rate=syn_rate, syn_synack_ratio=ratio))
+        self._syn_by_dst.clear()
+        self._synack_by_src.clear()
+
+        for src, ports in self._scan_ports.items():
+            if len(ports) >= self.scan_ports_threshold:
+                events.append(self._event("port_scan", now, src=src, distinct_ports=len(ports),
+                                          window=self.scan_window))
+        if now - self._scan_window_start >= self.scan_window:
+            self._scan_ports.clear()
+            self._scan_window_start = now
+
+        return [e for e in events if e is not None]
+
+    def _event(self, kind: str, now: float, **details) -> Optional[Dict]:
+        key = (kind, str(details.get("protocol") or details.get("dst") or details.get("src")))
+        if now - self._last_fired.get(key, 0.0) < self.cooldown:
+            return None
+        if len(self._last_fired) >= self.max_tracked:
+            self._last_fired = {k: t for k, t in self._last_fired.items() if now - t < self.cooldown}
+        self._last_fired[key] = now
+        self._seq += 1
+        event = {"id": self._seq, "type": kind, "timestamp": datetime.fromtimestamp(now).isoformat(), **details}
+        self.events.append(event)
+        anomaly_events.labels(type=kind).inc()
+        print(f"⚠️ Anomaly detected: {event}")
+        return event
+
+    def export_state(self) -> Tuple[Dict, Dict]:
+        """Learned rates and recent events for a state snapshot"""
+        with self._lock:
+            meta = {
+                "rates": {p: [d.mean, d.var, d.samples] for p, d in self.rates.items()},
+                "seq": self._seq,
+                "events": list(self.events),
+            }
+        return meta, {}
+
+    def restore_state(self, meta: Dict, arrays: Dict, since: Optional[float] = None):
+        """Learned rates are kept as is; events detected before `since` are dropped"""
+        events = meta.get("events", [])
+        if since is not None:
+            events = [e for e in events if datetime.fromisoformat(e["timestamp"]).timestamp() >= since]
+        with self._lock:
+            for protocol, (mean, var, samples) in meta.get("rates", {}).items():
+                detector = self.rates[protocol] = EwmaDetector()
+                detector.mean, detector.var, detector.samples = mean, var, samples
+            self.events.extend(events)
+            self._seq = max(self._seq, meta.get("seq", 0))
+
+    def events_since(self, last_id: int) -> List[Dict]:
+        """Events newer than `last_id` (for per-client WebSocket delivery)"""
+        with self._lock:
+            return [e for e in self.events if e["id"] > last_id]
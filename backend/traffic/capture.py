@@ -0,0 +1,276 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from collections import defaultdict
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import logging
+
+from traffic.classifier import PAYLOAD_PREFIX_BYTES, FlowClassifier
+from traffic.instrumentation import capture_latency, dropped_packets, stage_duration
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_MAX_BATCH = 500
+
+
+class CaptureTarget:
+    """One interface to capture on, optionally sharded across several worker processes"""
+
+    def __init__(self, interface: Optional[str], workers: int = 1, offline: Optional[str] = None):
+        self.interface = interface
+        self.workers = max(1, int(workers))
+        self.offline = offline  # путь к pcap-файлу вместо живого интерфейса
+
+    @property
+    def name(self) -> str:
+        return self.interface or self.offline
+
+    def __repr__(self):
+        if self.offline:
+            return f"CaptureTarget(offline={self.offline!r}, workers={self.workers})"
+        return f"CaptureTarget({self.interface!r}, workers={self.workers})"
+
+
+def parse_capture_config(value: Optional[str], default_workers: int = 1) -> List[CaptureTarget]:
+    """
+    Parse an interface list like "eth0:4,wlan0" into capture targets.
+    The optional ":N" suffix sets the number of flow-hash shards for that interface.
+    """
+    targets = []
+    if not value:
+        return targets
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, workers = item.rpartition(":")
+        if not name or not workers.isdigit():
+            # имена интерфейсов в Windows могут содержать ':' - тогда это не число воркеров
+            name, workers = item, default_workers
+        targets.append(CaptureTarget(name, int(workers)))
+    return targets
+
+
+def capture_targets_from_env(environ=None) -> List[CaptureTarget]:
+    """
+    Build capture targets from CAPTURE_INTERFACES, CAPTURE_WORKERS and CAPTURE_PCAP.
+    Returns an empty list when capture is not configured.
+    """
+    environ = os.environ if environ is None else environ
+    default_workers = int(environ.get("CAPTURE_WORKERS") or 1)
+    targets = parse_capture_config(environ.get("CAPTURE_INTERFACES"), default_workers)
+    for path in filter(None, (environ.get("CAPTURE_PCAP") or "").split(",")):
+        targets.append(CaptureTarget(None, default_workers, offline=path.strip()))
+    return targets
+
+
+def shard_filter(shard: int, n_shards: int) -> Optional[str]:
+    """
+    BPF filter selecting one shard of the traffic by a symmetric hash of the IPv4 pair,
+    so both directions of a flow are always handled by the same worker. Non-IPv4 traffic
+    (IPv6, ARP, ...) goes to shard 0; a single worker captures everything (None = no filter).
+    """
+    if n_shards <= 1:
+        return None
+    ip_shard = f"(ip and (ip[12:4] ^ ip[16:4]) % {n_shards} = {shard})"
+    return f"not ip or {ip_shard}" if shard == 0 else ip_shard
+
+
+def _merge_aggregates(target: Dict[str, List[int]], partial: Dict[str, Tuple[int, int]]):
+    for protocol, (count, size) in partial.items():
+        entry = target[protocol]
+        entry[0] += count
+        entry[1] += size
+
+
+def _new_batch_stats() -> Dict:
+    return {"captured_at": None, "convert_seconds": 0.0, "parse_errors": 0}
+
+
+def capture_worker(worker_id: str, interface: Optional[str], shard: int, n_shards: int, out_queue,
+                   stop_event, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                   max_batch: int = DEFAULT_MAX_BATCH, offline: Optional[str] = None):
+    """
+    Entry point of a capture process: sniffs its shard of the interface, converts packets
+    to dicts and ships them in batches together with partial per-protocol aggregates.
+    """
+    # scapy импортируем только в дочернем процессе
+    from traffic.sniffer import sniff_interface, packet_to_dict, payload_prefix
+
+    source = interface or offline
+    lock = threading.Lock()
+    batch: List[dict] = []
+    partial: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    # служебная статистика батча для метрик конвейера в API-процессе
+    stats = _new_batch_stats()
+    # L7-классификация раз на поток; шардирование по хэшу адресов держит поток в одном воркере
+    classifier = FlowClassifier()
+
+    def flush():
+        nonlocal batch, partial, stats
+        with lock:
+            if not batch and not stats["parse_errors"]:
+                return
+            packets, aggregates, batch_stats = batch, dict(partial), stats
+            batch, partial, stats = [], defaultdict(lambda: [0, 0]), _new_batch_stats()
+        try:
+            out_queue.put((worker_id, packets, aggregates, batch_stats))
+        except Exception as e:
+            logger.error(f"Worker {worker_id} failed to publish batch: {e}")
+
+    def on_packet(pkt):
+        started = time.perf_counter()
+        packet = packet_to_dict(pkt)
+        if packet is None:
+            with lock:
+                stats["parse_errors"] += 1
+            return
+        packet["interface"] = source
+        classifier.classify(packet, lambda: payload_prefix(pkt, PAYLOAD_PREFIX_BYTES))
+        tcp = packet.get("tcp_info")
+        if tcp is not None and ("F" in tcp["flags"] or "R" in tcp["flags"]):
+            classifier.forget(packet)
+        convert_seconds = time.perf_counter() - started
+        size = packet["length"]
+        with lock:
+            if stats["captured_at"] is None:
+                # у живого захвата pkt.time - время ядра; у pcap оно историческое, берем время чтения
+                stats["captured_at"] = float(pkt.time) if offline is None else time.time()
+            stats["convert_seconds"] += convert_seconds
+            batch.append(packet)
+            for protocol in packet["protocols"]:
+                entry = partial[protocol]
+                entry[0] += 1
+                entry[1] += size
+            full = len(batch) >= max_batch
+        if full:
+            flush()
+
+    def flusher():
+        while not stop_event.wait(flush_interval):
+            flush()
+        flush()
+
+    threading.Thread(target=flusher, name="capture-flusher", daemon=True).start()
+    sniff_interface(interface, on_packet, bpf_filter=shard_filter(shard, n_shards),
+                    stop_event=stop_event, offline=offline)
+    flush()
+
+
+class CaptureManager:
+    """
+    Runs one capture process per (interface, shard) and merges their output in the API process.
+    Converted packets are handed to `callback` in batches; totals are kept per worker so the
+    merged view can be recomputed at any time.
+    """
+
+    def __init__(self, targets: List[CaptureTarget], callback: Callable[[List[dict]], None],
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, max_batch: int = DEFAULT_MAX_BATCH):
+        self.targets = targets
+        self.callback = callback
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.processes: Dict[str, mp.Process] = {}
+        self.worker_aggregates: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        self.worker_packets: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._stop_event = None
+        self._drain_thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        ctx = mp.get_context()
+        self._queue = ctx.Queue()
+        self._stop_event = ctx.Event()
+        for target in self.targets:
+            for shard in range(target.workers):
+                worker_id = f"{target.name}#{shard}"
+                process = ctx.Process(
+                    target=capture_worker,
+                    args=(worker_id, target.interface, shard, target.workers, self._queue,
+                          self._stop_event, self.flush_interval, self.max_batch, target.offline),
+                    name=f"capture-{worker_id}",
+                    daemon=True,
+                )
+                process.start()
+                self.processes[worker_id] = process
+                print(f"Started capture worker {worker_id} (pid {process.pid})")
+        self.running = True
+        self._drain_thread = threading.Thread(target=self._drain, name="capture-drain", daemon=True)
+        self._drain_thread.start()
+
+    def _drain(self):
+        while self.running:
+            try:
+                worker_id, packets, aggregates, stats = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            if stats["captured_at"] is not None:
+                capture_latency.observe(max(0.0, time.time() - stats["captured_at"]))
+            if packets:
+                stage_duration.labels(stage="packet_to_dict").observe(stats["convert_seconds"])
+            if stats["parse_errors"]:
+                dropped_packets.labels(reason="parse_error").inc(stats["parse_errors"])
+            with self._lock:
+                _merge_aggregates(self.worker_aggregates[worker_id], aggregates)
+                self.worker_packets[worker_id] += len(packets)
+            try:
+                self.callback(packets)
+            except Exception as e:
+                logger.error(f"Error handling batch from {worker_id}: {e}")
+
+    def queue_depth(self) -> int:
+        """Batches waiting in the worker -> API queue"""
+        if self._queue is None:
+            return 0
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:  # macOS
+            return 0
+
+    def stop(self, timeout: float = 2.0):
+        if not self.running:
+            return
+        self.running = False
+        self._stop_event.set()
+        for worker_id, process in self.processes.items():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes.clear()
+        if self._drain_thread:
+            self._drain_thread.join(timeout)
+
+    def restore_aggregates(self, aggregates: Dict):
+        """Carry over totals from a previous run (a get_aggregates() result) as worker "restored" """
+        with self._lock:
+            self.worker_aggregates["restored"] = defaultdict(lambda: [0, 0], {
+                p: [v["count"], v["total_size"]] for p, v in aggregates.get("protocols", {}).items()
+            })
+            self.worker_packets["restored"] = aggregates.get("total_packets", 0)
+
+    def get_aggregates(self) -> Dict:
+        """Per-worker and merged per-protocol packet/byte totals"""
+        with self._lock:
+            merged: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+            workers = {}
+            for worker_id in set(self.processes) | set(self.worker_aggregates):
+                _merge_aggregates(merged, self.worker_aggregates.get(worker_id, {}))
+                process = self.processes.get(worker_id)
+                workers[worker_id] = {
+                    "packets": self.worker_packets[worker_id],
+                    "alive": bool(process and process.is_alive()),
+                }
+        return {
+            "workers": workers,
+            "protocols": {p: {"count": c, "total_size": s} for p, (c, s) in merged.items()},
+            "total_packets": sum(w["packets"] for w in workers.values()),
+        }
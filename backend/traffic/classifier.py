@@ -0,0 +1,141 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Имена сервисов совпадают с ключами optimizer_logs и QoS-правил ("HTTP", "TLS", "DNS")
+TCP_PORT_SERVICES = {
+    20: "FTP", 21: "FTP", 22: "SSH", 23: "Telnet", 25: "SMTP", 53: "DNS", 80: "HTTP", 110: "POP3",
+    143: "IMAP", 443: "TLS", 465: "TLS", 587: "SMTP", 853: "TLS", 993: "TLS", 995: "TLS",
+    1883: "MQTT", 3306: "MySQL", 3389: "RDP", 5432: "PostgreSQL", 6379: "Redis",
+    8000: "HTTP", 8080: "HTTP", 8443: "TLS",
+}
+UDP_PORT_SERVICES = {
+    53: "DNS", 67: "DHCP", 68: "DHCP", 123: "NTP", 161: "SNMP", 443: "QUIC", 853: "DNS",
+    1900: "SSDP", 5353: "DNS",
+}
+
+# Сигнатуры начала payload: имеют приоритет над портом (HTTP на 443, TLS на 8080 и т.п.)
+PAYLOAD_SIGNATURES = (
+    (b"GET ", "HTTP"), (b"POST ", "HTTP"), (b"PUT ", "HTTP"), (b"HEAD ", "HTTP"), (b"DELETE ", "HTTP"),
+    (b"OPTIONS ", "HTTP"), (b"PATCH ", "HTTP"), (b"CONNECT ", "HTTP"), (b"HTTP/1.", "HTTP"),
+    (b"PRI * HTTP/2", "HTTP"),
+    (b"\x16\x03", "TLS"), (b"\x17\x03", "TLS"), (b"\x15\x03", "TLS"),
+    (b"SSH-", "SSH"),
+    (b"\x13BitTorrent protocol", "BitTorrent"),
+)
+PAYLOAD_PREFIX_BYTES = max(len(prefix) for prefix, _ in PAYLOAD_SIGNATURES)
+
+# Слои без собственного смысла для классификации
+GENERIC_LAYERS = ("Raw", "Padding")
+
+SERVICES: List[Optional[str]] = [None] + sorted(set(TCP_PORT_SERVICES.values()) | set(UDP_PORT_SERVICES.values()))
+_SERVICE_INDEX = {name: i for i, name in enumerate(SERVICES)}
+
+
+def _port_table(services: Dict[int, str]) -> bytearray:
+    """Port -> index into SERVICES (0 = unknown), one byte per port"""
+    table = bytearray(65536)
+    for port, name in services.items():
+        table[port] = _SERVICE_INDEX[name]
+    return table
+
+
+_TCP_PORTS = _port_table(TCP_PORT_SERVICES)
+_UDP_PORTS = _port_table(UDP_PORT_SERVICES)
+
+# первый байт -> сигнатуры, начинающиеся с него (длинные раньше)
+_SIGNATURES_BY_FIRST_BYTE: Dict[int, Tuple[Tuple[bytes, str], ...]] = {}
+for _prefix, _name in sorted(PAYLOAD_SIGNATURES, key=lambda s: -len(s[0])):
+    _SIGNATURES_BY_FIRST_BYTE[_prefix[0]] = _SIGNATURES_BY_FIRST_BYTE.get(_prefix[0], ()) + ((_prefix, _name),)
+
+
+def service_by_port(transport: str, sport: int, dport: int) -> Optional[str]:
+    """Well-known service of a port pair; the destination port wins"""
+    table = _TCP_PORTS if transport == "TCP" else _UDP_PORTS
+    return SERVICES[table[dport] or table[sport]]
+
+
+def service_by_payload(payload: bytes) -> Optional[str]:
+    """Service whose signature the payload starts with"""
+    if not payload:
+        return None
+    for prefix, name in _SIGNATURES_BY_FIRST_BYTE.get(payload[0], ()):
+        if payload.startswith(prefix):
+            return name
+    return None
+
+
+class FlowClassifier:
+    """
+    Application-protocol classification of packet dicts, done once per flow.
+
+    Flows are keyed by the direction-independent 5-tuple. A flow gets its port-based service
+    right away and is finalized by the first packet that carries a payload (signature match,
+    falling back to the port). Afterwards packets cost one dict lookup.
+    """
+
+    def __init__(self, max_flows: int = 65536):
+        self.max_flows = max_flows
+        # ключ потока -> [сервис, окончательно ли]
+        self.flows: Dict[Tuple, List] = {}
+
+    @staticmethod
+    def flow_key(packet: Dict) -> Optional[Tuple]:
+        info = packet.get("tcp_info")
+        transport = "TCP"
+        if info is None:
+            info = packet.get("udp_info")
+            transport = "UDP"
+            if info is None:
+                return None
+        a = (packet.get("src"), info["sport"])
+        b = (packet.get("dst"), info["dport"])
+        return (transport, a, b) if a <= b else (transport, b, a)
+
+    def classify(self, packet: Dict, payload: Callable[[], bytes]) -> Optional[str]:
+        """
+        Set packet["app_protocol"] and add the service to packet["protocols"] if missing.
+        `payload` returns the first PAYLOAD_PREFIX_BYTES of the L4 payload (b"" for none, padding
+        excluded); it is only called until a non-empty payload has been checked against signatures.
+        """
+        key = self.flow_key(packet)
+        if key is None:
+            return None
+        entry = self.flows.get(key)
+        if entry is None:
+            if len(self.flows) >= self.max_flows:
+                # вытесняем самый старый поток
+                del self.flows[next(iter(self.flows))]
+            info = packet.get("tcp_info") or packet["udp_info"]
+            entry = self.flows[key] = [service_by_port(key[0], info["sport"], info["dport"]), False]
+        if not entry[1]:
+            data = payload()
+            if data:
+                entry[0] = service_by_payload(data) or entry[0]
+                entry[1] = True
+
+        service = entry[0]
+        if service is not None:
+            packet["app_protocol"] = service
+            protocols = packet.get("protocols")
+            if protocols is not None and service not in protocols:
+                protocols.append(service)
+        return service
+
+    def forget(self, packet: Dict):
+        """Drop the flow of a packet (e.g. after FIN/RST) so a reused 5-tuple is classified anew"""
+        key = self.flow_key(packet)
+        if key is not None:
+            self.flows.pop(key, None)
+
+    def __len__(self):
+        return len(self.flows)
+
+
+def traffic_class(packet: Dict) -> str:
+    """Most specific protocol of a packet: its application protocol, else its top named layer"""
+    service = packet.get("app_protocol")
+    if service is not None:
+        return service
+    for layer in reversed(packet.get("protocols", ())):
+        if layer not in GENERIC_LAYERS:
+            return layer
+    return "Unknown"
@@ -0,0 +1,309 @@
+"""
+Standalone capture engine shared by several API workers.
+
+The engine runs the capture processes once and fans every converted batch out to subscribers
+over a multiprocessing.connection socket (Unix socket path or host:port). Each API worker
+subscribes, feeds the stream into its own metrics/optimizer state and serves its own WebSocket
+clients, so the API can run with `uvicorn --workers N` or on several hosts.
+
+    cd backend
+    ENGINE_ADDRESS=/tmp/traffic-engine.sock CAPTURE_INTERFACES=eth0:4 python -m traffic.engine
+    ENGINE_ADDRESS=/tmp/traffic-engine.sock uvicorn main:app --workers 4
+
+Messages are (topic, payload) tuples: "packets" (list of packet dicts), "aggregates"
+(CaptureManager.get_aggregates()) and anything a subscriber publishes (e.g. "qos_rules_changed"),
+which the engine relays to every subscriber.
+"""
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from multiprocessing.connection import Client, Listener
+import os
+import pickle
+import queue
+import signal
+import threading
+import logging
+
+from traffic.capture import CaptureManager, capture_targets_from_env
+from traffic.instrumentation import dropped_packets
+from traffic.packetlog import PacketLogWriter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PENDING = 256        # батчей в очереди одного подписчика
+DEFAULT_AGGREGATES_INTERVAL = 1.0
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_engine_address(value: str) -> Address:
+    """"/path/engine.sock" or "unix:/path" -> Unix socket, "host:port" -> TCP"""
+    if value.startswith("unix:"):
+        return value[len("unix:"):]
+    if "/" in value:
+        return value
+    host, _, port = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def engine_authkey(address: Address, environ=None) -> Optional[bytes]:
+    """ENGINE_AUTHKEY from the environment; mandatory for TCP since messages are pickled"""
+    environ = os.environ if environ is None else environ
+    key = environ.get("ENGINE_AUTHKEY")
+    if not key and isinstance(address, tuple):
+        raise ValueError("ENGINE_AUTHKEY must be set when the engine listens on TCP")
+    return key.encode() if key else None
+
+
+class _Subscriber:
+    def __init__(self, conn, name: str, max_pending: int):
+        self.conn = conn
+        self.name = name
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.alive = True
+
+
+class EngineServer:
+    """Runs a CaptureManager and publishes its batches and aggregates to all subscribers"""
+
+    def __init__(self, address: Address, targets, authkey: Optional[bytes] = None,
+                 max_pending: int = DEFAULT_MAX_PENDING,
+                 aggregates_interval: float = DEFAULT_AGGREGATES_INTERVAL,
+                 packet_log: Optional[PacketLogWriter] = None):
+        self.address = address
+        self.authkey = authkey
+        self.max_pending = max_pending
+        self.aggregates_interval = aggregates_interval
+        self.packet_log = packet_log
+        self.capture = CaptureManager(targets, self._on_packets)
+        self.subscribers: List[_Subscriber] = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._listener = None
+
+    def start(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)  # сокет от прошлого запуска
+        self._listener = Listener(self.address, authkey=self.authkey)
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)  # сообщения - pickle, подписчики только от того же пользователя
+        threading.Thread(target=self._accept, name="engine-accept", daemon=True).start()
+        threading.Thread(target=self._publish_aggregates, name="engine-aggregates", daemon=True).start()
+        self.capture.start()
+        logger.info(f"Capture engine listening on {self.address}")
+
+    def _on_packets(self, packets: List[dict]):
+        self.publish("packets", packets)
+        if self.packet_log is not None:
+            # лог пишет только движок, API-воркеры читают каталог напрямую
+            try:
+                self.packet_log.append(packets)
+            except Exception as e:
+                logger.error(f"Error writing packet log: {e}")
+
+    def publish(self, topic: str, payload):
+        """Queue a message for every subscriber; a slow subscriber loses its oldest batches"""
+        # сериализуем один раз на всех подписчиков
+        message = (len(payload) if topic == "packets" else 0, pickle.dumps((topic, payload), pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.pending.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        dropped, _ = subscriber.pending.get_nowait()
+                    except queue.Empty:
+                        continue
+                    if dropped:
+                        dropped_packets.labels(reason="subscriber_slow").inc(dropped)
+
+    def _accept(self):
+        while not self._stop_event.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                break
+            except Exception as e:  # неверный authkey и т.п.
+                logger.warning(f"Rejected subscriber: {e}")
+                continue
+            subscriber = _Subscriber(conn, f"subscriber-{id(conn):x}", self.max_pending)
+            with self._lock:
+                self.subscribers.append(subscriber)
+            threading.Thread(target=self._send_loop, args=(subscriber,), name=f"engine-send-{subscriber.name}",
+                             daemon=True).start()
+            threading.Thread(target=self._receive_loop, args=(subscriber,), name=f"engine-recv-{subscriber.name}",
+                             daemon=True).start()
+            # новый подписчик сразу получает текущие итоги
+            subscriber.pending.put((0, pickle.dumps(("aggregates", self.capture.get_aggregates()))))
+            logger.info(f"Subscriber connected ({len(self.subscribers)} total)")
+
+    def _send_loop(self, subscriber: _Subscriber):
+        while subscriber.alive and not self._stop_event.is_set():
+            try:
+                _, data = subscriber.pending.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                subscriber.conn.send_bytes(data)
+            except (OSError, EOFError, ValueError):
+                self._drop(subscriber)
+
+    def _receive_loop(self, subscriber: _Subscriber):
+        # подписчики публикуют управляющие сообщения (например, новые QoS-правила) - раздаем всем
+        while subscriber.alive:
+            try:
+                topic, payload = subscriber.conn.recv()
+            except (OSError, EOFError, ValueError):
+                self._drop(subscriber)
+                return
+            except Exception as e:
+                logger.warning(f"Bad message from {subscriber.name}: {e}")
+                continue
+            self.publish(topic, payload)
+
+    def _drop(self, subscriber: _Subscriber):
+        with self._lock:
+            if not subscriber.alive:
+                return
+            subscriber.alive = False
+            self.subscribers.remove(subscriber)
+        try:
+            subscriber.conn.close()
+        except OSError:
+            pass
+        logger.info(f"Subscriber disconnected ({len(self.subscribers)} left)")
+
+    def _publish_aggregates(self):
+        while not self._stop_event.wait(self.aggregates_interval):
+            self.publish("aggregates", self.capture.get_aggregates())
+
+    def wait(self):
+        self._stop_event.wait()
+
+    def request_stop(self):
+        """Make wait() return (safe to call from a signal handler)"""
+        self._stop_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self.capture.stop()
+        if self.packet_log is not None:
+            self.packet_log.close()
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            self._drop(subscriber)
+
+
+class EngineSubscriber:
+    """
+    API-side connection to the engine. Received messages are dispatched to `handlers[topic]`
+    on a background thread; the connection is re-established if the engine restarts.
+    """
+
+    def __init__(self, address: Address, handlers: Dict[str, Callable], authkey: Optional[bytes] = None,
+                 retry_delay: float = 1.0, on_connect: Optional[Callable[[], None]] = None):
+        self.address = address
+        self.handlers = handlers
+        self.on_connect = on_connect
+        self.authkey = authkey
+        self.retry_delay = retry_delay
+        self.aggregates: Dict = {"workers": {}, "protocols": {}, "total_packets": 0}
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="engine-subscriber", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._conn = Client(self.address, authkey=self.authkey)
+            except Exception as e:
+                logger.warning(f"Capture engine at {self.address} unavailable: {e}")
+                self._stop_event.wait(self.retry_delay)
+                continue
+            logger.info(f"Subscribed to capture engine at {self.address}")
+            if self.on_connect is not None:
+                # пока соединения не было, могли пропустить уведомления - даем подписчику пересинхронизироваться
+                try:
+                    self.on_connect()
+                except Exception as e:
+                    logger.error(f"Error in engine on_connect: {e}")
+            try:
+                while not self._stop_event.is_set():
+                    topic, payload = self._conn.recv()
+                    if topic == "aggregates":
+                        self.aggregates = payload
+                    handler = self.handlers.get(topic)
+                    if handler is None:
+                        continue
+                    try:
+                        handler(payload)
+                    except Exception as e:
+                        logger.error(f"Error handling engine message {topic}: {e}")
+            except (OSError, EOFError) as e:
+                if not self._stop_event.is_set():
+                    logger.warning(f"Lost connection to capture engine: {e}")
+            finally:
+                conn, self._conn = self._conn, None
+                try:
+                    conn.close()
+                except OSError:
+                    pass
+
+    def publish(self, topic: str, payload) -> bool:
+        """Send a message to the engine, which relays it to every subscriber (including this one)"""
+        conn = self._conn
+        if conn is None:
+            return False
+        try:
+            with self._send_lock:
+                conn.send((topic, payload))
+            return True
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not publish {topic} to capture engine: {e}")
+            return False
+
+    def stop(self):
+        self._stop_event.set()
+        conn = self._conn
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    address_value = os.getenv("ENGINE_ADDRESS")
+    if not address_value:
+        raise SystemExit("ENGINE_ADDRESS is not set")
+    targets = capture_targets_from_env()
+    if not targets:
+        raise SystemExit("Capture is not configured (CAPTURE_INTERFACES / CAPTURE_PCAP)")
+    address = parse_engine_address(address_value)
+    log_dir = os.getenv("PACKET_LOG_DIR")
+    server = EngineServer(address, targets, authkey=engine_authkey(address),
+                          packet_log=PacketLogWriter(log_dir) if log_dir else None)
+    signal.signal(signal.SIGTERM, lambda *_: server.request_stop())
+    signal.signal(signal.SIGINT, lambda *_: server.request_stop())
+    server.start()
+    server.wait()
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
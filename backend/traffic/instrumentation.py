@@ -0,0 +1,35 @@
+from typing import Callable
+import asyncio
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Метрики самого конвейера обработки (в отличие от метрик трафика в NetworkMetricsCollector)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+stage_duration = Histogram(
+    'pipeline_stage_duration_seconds', 'Time spent in a pipeline stage per processed batch',
+    ['stage'], buckets=STAGE_BUCKETS
+)
+capture_latency = Histogram(
+    'pipeline_capture_to_callback_seconds',
+    'Delay between capturing the oldest packet of a batch and the batch reaching the API process',
+    buckets=STAGE_BUCKETS
+)
+queue_depth = Gauge('pipeline_queue_depth', 'Number of items waiting in a pipeline queue', ['queue'])
+dropped_packets = Counter('pipeline_dropped_packets_total', 'Packets dropped by the pipeline', ['reason'])
+event_loop_lag = Gauge('pipeline_event_loop_lag_seconds', 'How late the asyncio event loop wakes up a sleeping task')
+websocket_clients = Gauge('pipeline_websocket_clients', 'Connected WebSocket clients')
+
+
+def track_queue(name: str, size: Callable[[], int]):
+    """Export the size of a queue; `size` is only called when /metrics is scraped"""
+    queue_depth.labels(queue=name).set_function(size)
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Background task measuring event-loop lag: how much later than requested a sleep returns"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag.set(max(0.0, time.perf_counter() - started - interval))
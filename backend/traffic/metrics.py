@@ -1,42 +1,95 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import time
 from collections import defaultdict
-from prometheus_client import Counter, Gauge, Histogram
-import pandas as pd
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram
 import numpy as np
+from traffic.optimizer_logs import DEFAULT_OPTIMIZATION_SETTINGS, get_optimized_sizes, membership_from_masks
+from traffic.protocols import STACKS, stack_id_of
+
+MAX_PROTOCOL_LABELS = 32  # ограничение кардинальности метки protocol
+OTHER_PROTOCOL_LABEL = "other"
+DEDUPLICATED_PROTOCOLS = ("Ethernet", "IP")
+# поля истории, попадающие в снапшот состояния, и их тип на диске
+HISTORY_DTYPES = {"packet_sizes": np.int64, "timestamps": np.float64, "stack_ids": np.int32,
+                  "optimized_sizes": np.float64}
 
 class NetworkMetricsCollector:
-    def __init__(self):
-        self.packets_total = Counter('network_packets_total', 'Total number of packets', ['protocol'])
-        self.bandwidth_usage = Gauge('network_bandwidth_bytes', 'Current bandwidth usage in bytes', ['protocol'])
-        self.latency_hist = Histogram('network_latency_seconds', 'Network latency in seconds')
+    def __init__(self, optimization_settings: Optional[Dict] = None, seed: Optional[int] = None,
+                 registry: CollectorRegistry = REGISTRY):
+        self.packets_total = Counter('network_packets_total', 'Total number of packets', ['protocol'], registry=registry)
+        # счетчик байт: rate(network_protocol_bytes_total[1m]) = полоса по протоколу
+        self.bytes_total = Counter('network_protocol_bytes', 'Bytes captured per protocol', ['protocol'], registry=registry)
+        self.latency_hist = Histogram('network_latency_seconds', 'Network latency in seconds', registry=registry)
 
         self.metrics_history = defaultdict(list)  # оригинальные
         self.optimized_history = defaultdict(list)  # оптимизированные
         self.start_time = time.time()
         self.optimized_start_time = None  
+        # симуляция оптимизации размеров (optimizer_logs), seed для воспроизводимости
+        self.optimization_settings = dict(optimization_settings or DEFAULT_OPTIMIZATION_SETTINGS)
+        self.rng = np.random.default_rng(seed)
+        self._protocol_labels = set()
+        self._stack_counted: Dict[int, Tuple[str, ...]] = {}  # stack id -> протоколы без Ethernet/IP
 
     def record_packet(self, packet: Dict, optimized: bool = False):
-        """Record metrics for a single packet. If optimized=True, save in optimized_history."""
+        """Record a single packet in the history. If optimized=True, save in optimized_history."""
+        self._record(packet, optimized)
+
+    def record_packets(self, packets: List[Dict], optimized: bool = False):
+        """Record a batch of packets in the history"""
+        for packet in packets:
+            self._record(packet, optimized)
+
+    def count_packets(self, packets: List[Dict]):
+        """
+        Update the Prometheus packet/byte counters for a captured batch. Call it from the capture
+        path, which sees every packet exactly once, so rate() of the counters is link bandwidth.
+        """
+        stack_packets = defaultdict(int)
+        stack_bytes = defaultdict(int)
+        for packet in packets:
+            stack_id = stack_id_of(packet)
+            stack_packets[stack_id] += 1
+            stack_bytes[stack_id] += packet.get("length", 0)
+        # раскладываем счетчики по стекам на протоколы раз на батч
+        packets_by_protocol = defaultdict(int)
+        bytes_by_protocol = defaultdict(int)
+        for stack_id, count in stack_packets.items():
+            stack = STACKS.stacks[stack_id]
+            # Ethernet и IP - раз на пакет, остальные протоколы - по числу вхождений в стек
+            for protocol in DEDUPLICATED_PROTOCOLS:
+                if protocol in stack:
+                    packets_by_protocol[protocol] += count
+            for protocol in self._counted_protocols(stack_id):
+                packets_by_protocol[protocol] += count
+            # байты - раз на пакет для каждого протокола стека: туннель IP/GRE/IP не удваивает полосу IP
+            for protocol in dict.fromkeys(stack):
+                bytes_by_protocol[protocol] += stack_bytes[stack_id]
+        for protocol, count in packets_by_protocol.items():
+            self.packets_total.labels(protocol=self._protocol_label(protocol)).inc(count)
+        for protocol, size in bytes_by_protocol.items():
+            self.bytes_total.labels(protocol=self._protocol_label(protocol)).inc(size)
+
+    def _counted_protocols(self, stack_id: int) -> Tuple[str, ...]:
+        counted = self._stack_counted.get(stack_id)
+        if counted is None:
+            counted = self._stack_counted[stack_id] = tuple(
+                p for p in STACKS.stacks[stack_id] if p not in DEDUPLICATED_PROTOCOLS
+            )
+        return counted
+
+    def _protocol_label(self, protocol: str) -> str:
+        """Label value for a protocol; after MAX_PROTOCOL_LABELS distinct names new ones become 'other'"""
+        if protocol in self._protocol_labels:
+            return protocol
+        if len(self._protocol_labels) < MAX_PROTOCOL_LABELS:
+            self._protocol_labels.add(protocol)
+            return protocol
+        return OTHER_PROTOCOL_LABEL
+
+    def _record(self, packet: Dict, optimized: bool):
         packet_size = packet.get("length", 0)
-        protocols = packet.get("protocols", [])
-        
-        packet_id = f"{packet.get('src', '')}-{packet.get('dst', '')}-{packet.get('timestamp', '')}"
-        
-        for protocol in protocols:
-            # Для Ethernet и IP считаем только уникальные пакеты
-            if protocol in ["Ethernet", "IP"]:
-                if packet_id not in self.metrics_history.get(f"{protocol}_packets", set()):
-                    self.packets_total.labels(protocol=protocol).inc()
-                    if optimized:
-                        self.optimized_history[f"{protocol}_packets"] = self.optimized_history.get(f"{protocol}_packets", set()) | {packet_id}
-                    else:
-                        self.metrics_history[f"{protocol}_packets"] = self.metrics_history.get(f"{protocol}_packets", set()) | {packet_id}
-            else:
-                # Для остальных протоколов считаем все пакеты
-                self.packets_total.labels(protocol=protocol).inc()
-            
-            self.bandwidth_usage.labels(protocol=protocol).set(packet_size)
+        stack_id = stack_id_of(packet)
 
         # определяем время для латентности
         current_time = time.time()
@@ -49,11 +102,11 @@ class NetworkMetricsCollector:
                 self.optimized_start_time = current_time
             self.optimized_history["packet_sizes"].append(packet_size)
             self.optimized_history["timestamps"].append(current_time)
-            self.optimized_history["protocols"].extend(protocols)
+            self.optimized_history["stack_ids"].append(stack_id)
         else:
             self.metrics_history["packet_sizes"].append(packet_size)
             self.metrics_history["timestamps"].append(current_time)
-            self.metrics_history["protocols"].extend(protocols)
+            self.metrics_history["stack_ids"].append(stack_id)
 
     def calculate_statistics(self) -> Dict:
         """Calculate various network statistics including original and optimized."""
@@ -73,14 +126,16 @@ class NetworkMetricsCollector:
                 "throughput": float(np.sum(packet_sizes) / (timestamps[-1] - timestamps[0])) if len(timestamps) > 1 else 0,
             })
           
-            protocol_counts = pd.Series(self.metrics_history["protocols"]).value_counts()
-            stats["protocol_distribution"] = protocol_counts.to_dict()
+            protocol_counts = defaultdict(int)
+            stack_counts = np.bincount(np.array(self.metrics_history["stack_ids"], dtype=np.int64))
+            for stack_id in np.flatnonzero(stack_counts):
+                for protocol in STACKS.stacks[stack_id]:
+                    protocol_counts[protocol] += int(stack_counts[stack_id])
+            stats["protocol_distribution"] = dict(sorted(protocol_counts.items(), key=lambda x: x[1], reverse=True))
             # average
             window_size = min(50, len(packet_sizes))
             if window_size > 0:
-                stats["moving_avg_size"] = float(
-                    pd.Series(packet_sizes).rolling(window=window_size).mean().iloc[-1]
-                )
+                stats["moving_avg_size"] = float(np.mean(packet_sizes[-window_size:]))
         else:
             stats.update({
                 "total_packets": 0,
@@ -95,9 +150,11 @@ class NetworkMetricsCollector:
                 "moving_avg_size": 0
             })
         if packet_sizes.size > 0:
-            optimized_size = packet_sizes * 0.8 
-            optimized_throughput = stats["original_throughput"] * 1.3  
-            
+            optimized_size = self._simulate_optimized_sizes(packet_sizes)
+            # те же данные передаются меньшим числом байт -> эффективная пропускная способность выше
+            compression_ratio = float(np.sum(packet_sizes)) / max(float(np.sum(optimized_size)), 1.0)
+            optimized_throughput = stats["original_throughput"] * compression_ratio
+
             stats.update({
                 "optimized_avg_size": float(np.mean(optimized_size)),
                 "optimized_throughput": optimized_throughput,
@@ -110,13 +167,74 @@ class NetworkMetricsCollector:
 
         return stats
 
+    def _simulate_optimized_sizes(self, packet_sizes: np.ndarray) -> np.ndarray:
+        """Simulated optimized sizes for all recorded packets; only new packets are simulated"""
+        simulated = self.metrics_history["optimized_sizes"]
+        done = len(simulated)
+        if done < packet_sizes.size:
+            stack_ids = self.metrics_history["stack_ids"][done:packet_sizes.size]
+            masks = np.array(STACKS.masks, dtype=np.int64)[stack_ids]
+            simulated.extend(get_optimized_sizes(
+                packet_sizes[done:], membership_from_masks(masks), self.optimization_settings, self.rng
+            ).tolist())
+        return np.array(simulated[:packet_sizes.size])
+
     def get_bandwidth_utilization(self) -> Dict[str, float]:
         """Calculate bandwidth utilization per protocol"""
         protocol_bandwidth = defaultdict(float)
-        for protocol, sizes in zip(self.metrics_history["protocols"], self.metrics_history["packet_sizes"]):
-            protocol_bandwidth[protocol] += sizes
+        if not self.metrics_history["packet_sizes"]:
+            return {}
+        stack_bytes = np.bincount(np.array(self.metrics_history["stack_ids"], dtype=np.int64),
+                                  weights=np.array(self.metrics_history["packet_sizes"], dtype=np.float64))
+        for stack_id in np.flatnonzero(stack_bytes):
+            for protocol in STACKS.stacks[stack_id]:
+                protocol_bandwidth[protocol] += float(stack_bytes[stack_id])
         return dict(protocol_bandwidth)
 
+    def export_state(self) -> Tuple[Dict, Dict[str, np.ndarray]]:
+        """
+        Histories as arrays for a state snapshot. Safe to call from another thread: each list
+        is copied in one step and aligned per-packet fields are cut to their common length.
+        """
+        arrays = {}
+        for prefix, history in (("history", self.metrics_history), ("optimized", self.optimized_history)):
+            columns = {name: history[name][:] for name in HISTORY_DTYPES if history.get(name)}
+            # optimized_sizes - кэш симуляции, может отставать от остальных полей
+            aligned = [len(c) for name, c in columns.items() if name != "optimized_sizes"]
+            length = min(aligned) if aligned else 0
+            for name, column in columns.items():
+                arrays[f"{prefix}_{name}"] = np.array(column[:length], dtype=HISTORY_DTYPES[name])
+        meta = {
+            "start_time": self.start_time,
+            "optimized_start_time": self.optimized_start_time,
+            "optimization_settings": self.optimization_settings,
+        }
+        return meta, arrays
+
+    def restore_state(self, meta: Dict, arrays: Dict[str, np.ndarray], since: Optional[float] = None):
+        """
+        Replace histories with the ones from a state snapshot. Packets recorded before `since`
+        are dropped so throughput is not averaged over the downtime.
+        """
+        self.metrics_history = defaultdict(list)
+        self.optimized_history = defaultdict(list)
+        for prefix, history in (("history", self.metrics_history), ("optimized", self.optimized_history)):
+            timestamps = arrays.get(f"{prefix}_timestamps")
+            # история упорядочена по времени - отрезаем общий префикс у всех полей
+            # (optimized_sizes выровнен по началу истории, поэтому режется так же)
+            first = 0 if since is None or timestamps is None else int(np.searchsorted(timestamps, since))
+            for name in HISTORY_DTYPES:
+                array = arrays.get(f"{prefix}_{name}")
+                if array is not None:
+                    history[name] = array[first:].tolist()
+        self.start_time = meta.get("start_time", self.start_time)
+        self.optimized_start_time = meta.get("optimized_start_time")
+        if since is not None:
+            self.start_time = max(self.start_time, since)
+            optimized_timestamps = self.optimized_history["timestamps"]
+            self.optimized_start_time = optimized_timestamps[0] if optimized_timestamps else None
+        self.optimization_settings = dict(meta.get("optimization_settings") or self.optimization_settings)
+
     def get_latency_metrics(self) -> Dict:
         """Get detailed latency metrics"""
         if not self.metrics_history["timestamps"]:
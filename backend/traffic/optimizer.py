@@ -1,16 +1,16 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from collections import defaultdict, deque
 import time
-from scapy.all import IP, TCP, UDP
 import queue
 import numpy as np
-from sklearn.cluster import KMeans
 from datetime import datetime
 import asyncio
 
-def optimize_packets(packets: List[Dict]) -> List[Dict]:
-    """Main optimization function"""
-    optimizer = TrafficOptimizer()
+from traffic.protocols import STACKS, stack_id_of
+
+def optimize_packets(packets: List[Dict], optimizer: Optional["TrafficOptimizer"] = None) -> List[Dict]:
+    """Main optimization function; pass the long-lived optimizer so its QoS rules apply"""
+    optimizer = optimizer or TrafficOptimizer()
     
     # распределяем 
     packets = optimizer.apply_traffic_shaping(packets)
@@ -36,6 +36,8 @@ class TrafficOptimizer:
         self.qos_rules = defaultdict(lambda: {"priority": 0, "bandwidth_limit": None})
         
         self.traffic_history = []
+        # stack id -> (приоритет, ((протокол, лимит, число вхождений), ...)); сбрасывается при смене правил
+        self._stack_qos: Dict[int, Tuple[int, Tuple[Tuple[str, float, int], ...]]] = {}
         self.queues: Dict[int, deque] = defaultdict(deque)  # ставим очередь пакетов по приоритетам
 
     def apply_traffic_shaping(self, packets):
@@ -60,6 +62,8 @@ class TrafficOptimizer:
         if not recommendations.get('optimization_needed'):
             return True
 
+        from scapy.layers.inet import IP
+
         src_ip = packet[IP].src if IP in packet else None
         if not src_ip:
             return True
@@ -109,6 +113,7 @@ class TrafficOptimizer:
         """
         Implement latency optimization strategies.
         """
+        from scapy.layers.inet import TCP
         if TCP in packet:
             if packet[TCP].flags & 0x08: 
                 return True
@@ -120,6 +125,7 @@ class TrafficOptimizer:
         """
         Analyze and suggest protocol optimizations.
         """
+        from scapy.layers.inet import TCP
         if TCP in packet:
             window_size = packet[TCP].window
             if window_size < 65535:
@@ -153,12 +159,55 @@ class TrafficOptimizer:
             "priority": priority,
             "bandwidth_limit": bandwidth_limit
         }
+        self._stack_qos = {}
     
     def remove_qos_rule(self, protocol: str):
         """Remove QoS rule for a specific protocol"""
         if protocol in self.qos_rules:
             del self.qos_rules[protocol]
-    
+        self._stack_qos = {}
+
+    def load_qos_rules(self, rules: Dict[str, Dict]):
+        """Replace all QoS rules ({protocol: {"priority", "bandwidth_limit"}})"""
+        qos_rules = defaultdict(lambda: {"priority": 0, "bandwidth_limit": None})
+        for protocol, rule in rules.items():
+            qos_rules[protocol] = {"priority": rule["priority"], "bandwidth_limit": rule.get("bandwidth_limit")}
+        # подменяем словари целиком: читатель видит либо старые, либо новые правила, но не пустые
+        self.qos_rules, self._stack_qos = qos_rules, {}
+
+    def _stack_rules(self, stack_id: int) -> Tuple[int, Tuple[Tuple[str, float, int], ...]]:
+        """Priority and bandwidth-limited protocols of an interned protocol stack (cached)"""
+        # кэш и правила берем один раз: после подмены устаревшая запись попадет только в старый кэш
+        cache, qos_rules = self._stack_qos, self.qos_rules
+        cached = cache.get(stack_id)
+        if cached is None:
+            stack = STACKS.stacks[stack_id]
+            max_priority = 0
+            limited = {}
+            for protocol in stack:
+                rule = qos_rules.get(protocol)
+                if rule is None:
+                    continue
+                max_priority = max(max_priority, rule["priority"])
+                if rule["bandwidth_limit"]:
+                    limited[protocol] = (protocol, rule["bandwidth_limit"], stack.count(protocol))
+            cached = cache[stack_id] = (max_priority, tuple(limited.values()))
+        return cached
+
+    def get_traffic_class(self, protocols: List[str]) -> Dict:
+        """
+        QoS class of a protocol stack: the rule with the highest priority among its layers
+        (first layer wins on ties), or the default class if no layer has a rule.
+        """
+        best = None
+        for protocol in protocols:
+            rule = self.qos_rules.get(protocol)
+            if rule is not None and (best is None or rule["priority"] > best[1]["priority"]):
+                best = (protocol, rule)
+        if best is None:
+            return {"name": "default", "priority": 0, "bandwidth_limit": None}
+        return {"name": best[0], "priority": best[1]["priority"], "bandwidth_limit": best[1]["bandwidth_limit"]}
+
     def analyze_traffic_patterns(self, packets: List[Dict]) -> Dict:
         """Analyze traffic patterns using machine learning"""
         if not packets:
@@ -173,6 +222,8 @@ class TrafficOptimizer:
         n_clusters = min(3, max(1, n_samples // 10))  
         
         if len(features) >= n_clusters:
+            # sklearn тяжелый, подгружаем только при первом анализе
+            from sklearn.cluster import KMeans
             model = KMeans(n_clusters=n_clusters, n_init=10)
             clusters = model.fit_predict(features)
             return {
@@ -186,19 +237,15 @@ class TrafficOptimizer:
     def apply_traffic_shaping(self, packets: List[Dict]) -> List[Dict]:
         """Apply traffic shaping based on QoS rules"""
         shaped_packets = []
+        timestamp = datetime.now().isoformat()
         
         for packet in packets:
-            protocols = packet.get("protocols", [])
-            
             # ставим приоритет 
-            max_priority = 0
-            for protocol in protocols:
-                priority = self.qos_rules[protocol]["priority"]
-                max_priority = max(max_priority, priority)
+            max_priority = self._stack_rules(stack_id_of(packet))[0]
             
             packet["qos"] = {
                 "priority": max_priority,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": timestamp
             }
             
             shaped_packets.append(packet)
@@ -208,24 +255,23 @@ class TrafficOptimizer:
 
     def optimize_bandwidth(self, packets: List[Dict]) -> List[Dict]:
         """Optimize bandwidth allocation"""
-        protocol_usage = defaultdict(int)
-        
+        stack_usage = defaultdict(int)
         for packet in packets:
-            for protocol in packet.get("protocols", []):
-                protocol_usage[protocol] += packet.get("length", 0)
+            stack_usage[stack_id_of(packet)] += packet.get("length", 0)
+
+        # трафик считаем только для протоколов с лимитом
+        protocol_usage = defaultdict(int)
+        for stack_id, size in stack_usage.items():
+            for protocol, _, occurrences in self._stack_rules(stack_id)[1]:
+                protocol_usage[protocol] += size * occurrences
+        throttled_stacks = {
+            stack_id: any(protocol_usage[protocol] > limit for protocol, limit, _ in self._stack_rules(stack_id)[1])
+            for stack_id in stack_usage
+        }
         
         optimized_packets = []
         for packet in packets:
-            protocols = packet.get("protocols", [])
-            should_throttle = False
-            
-            for protocol in protocols:
-                limit = self.qos_rules[protocol]["bandwidth_limit"]
-                if limit and protocol_usage[protocol] > limit:
-                    should_throttle = True
-                    break
-            
-            packet["throttled"] = should_throttle
+            packet["throttled"] = throttled_stacks[packet["stack_id"]]
             optimized_packets.append(packet)
         
         return optimized_packets
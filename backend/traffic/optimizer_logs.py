@@ -1,5 +1,8 @@
 import math
 import random
+from typing import Iterable, List, Optional
+
+import numpy as np
 
 def js_round(n: float) -> int:
     """
@@ -9,21 +12,34 @@ def js_round(n: float) -> int:
 
 MIN_COMPRESSIBLE_SIZE = 64
 
+PROTOCOL_OPTIMIZATION_EFFECTS = {
+    "HTTP": {"header_reduction_per_kb": (10, 20), "content_reduction_per_kb": (500, 700)}, # Bytes reduction per KB of packet_length
+    "TCP": {"header_reduction_per_kb": (3, 7), "content_reduction_per_kb": (50, 150)}, # Bytes reduction per KB of packet_length
+    "UDP": {"header_reduction_per_kb": (1, 5), "content_reduction_per_kb": (20, 80)}, # Bytes reduction per KB of packet_length
+    "ETHERNET": {"header_reduction_per_kb": (0, 2), "content_reduction_per_kb": (0, 0)}, # Very little to no compression
+    "IP": {"header_reduction_per_kb": (1, 3), "content_reduction_per_kb": (0, 0)}, # Very little to no compression
+    "TLS": {"header_reduction_per_kb": (0, 1), "content_reduction_per_kb": (1, 20)}, # Very low due to encryption
+    "DNS": {"header_reduction_per_kb": (3, 7), "content_reduction_per_kb": (3, 7)}, # Small, often non-compressible
+}
+NO_OPTIMIZATION_EFFECT = {"header_reduction_per_kb": (0, 0), "content_reduction_per_kb": (0, 0)}
+
+# Та же таблица в виде массивов для пакетной версии: строка = протокол, столбцы = (min, max)
+OPTIMIZATION_PROTOCOLS = tuple(PROTOCOL_OPTIMIZATION_EFFECTS)
+PROTOCOL_INDEX = {name: i for i, name in enumerate(OPTIMIZATION_PROTOCOLS)}
+HEADER_REDUCTION_PER_KB = np.array(
+    [PROTOCOL_OPTIMIZATION_EFFECTS[p]["header_reduction_per_kb"] for p in OPTIMIZATION_PROTOCOLS], dtype=np.float64)
+CONTENT_REDUCTION_PER_KB = np.array(
+    [PROTOCOL_OPTIMIZATION_EFFECTS[p]["content_reduction_per_kb"] for p in OPTIMIZATION_PROTOCOLS], dtype=np.float64)
+_PROTOCOL_BITS = np.arange(len(OPTIMIZATION_PROTOCOLS), dtype=np.int64)
+
+DEFAULT_OPTIMIZATION_SETTINGS = {"headerCompression": True, "contentCompression": True, "caching": True}
+
+
 def get_optimized_size(packet_length: int, protocols: list[str], settings: dict) -> int:
  
     current_size = float(packet_length)
     total_reduction_bytes = 0.0
 
-    PROTOCOL_OPTIMIZATION_EFFECTS = {
-        "HTTP": {"header_reduction_per_kb": (10, 20), "content_reduction_per_kb": (500, 700)}, # Bytes reduction per KB of packet_length
-        "TCP": {"header_reduction_per_kb": (3, 7), "content_reduction_per_kb": (50, 150)}, # Bytes reduction per KB of packet_length
-        "UDP": {"header_reduction_per_kb": (1, 5), "content_reduction_per_kb": (20, 80)}, # Bytes reduction per KB of packet_length
-        "ETHERNET": {"header_reduction_per_kb": (0, 2), "content_reduction_per_kb": (0, 0)}, # Very little to no compression
-        "IP": {"header_reduction_per_kb": (1, 3), "content_reduction_per_kb": (0, 0)}, # Very little to no compression
-        "TLS": {"header_reduction_per_kb": (0, 1), "content_reduction_per_kb": (1, 20)}, # Very low due to encryption
-        "DNS": {"header_reduction_per_kb": (3, 7), "content_reduction_per_kb": (3, 7)}, # Small, often non-compressible
-    }
-
     base_reduction_range = (0, 0) 
     if packet_length < 100:
         base_reduction_range = (1, 3) 
@@ -36,9 +52,7 @@ def get_optimized_size(packet_length: int, protocols: list[str], settings: dict)
 
     if packet_length >= MIN_COMPRESSIBLE_SIZE:
         for protocol in protocols:
-            proto_effects = PROTOCOL_OPTIMIZATION_EFFECTS.get(protocol.upper(), {
-                "header_reduction_per_kb": (0, 0), "content_reduction_per_kb": (0, 0)
-            })
+            proto_effects = PROTOCOL_OPTIMIZATION_EFFECTS.get(protocol.upper(), NO_OPTIMIZATION_EFFECT)
 
             scale_factor = packet_length / 1000.0 
 
@@ -65,6 +79,58 @@ def get_optimized_size(packet_length: int, protocols: list[str], settings: dict)
 
     return int(final_optimized_size)
 
+def protocol_mask(protocols: Iterable[str]) -> int:
+    """Bitmask of the known optimization protocols present in a packet's layer list"""
+    mask = 0
+    for protocol in protocols:
+        idx = PROTOCOL_INDEX.get(protocol.upper())
+        if idx is not None:
+            mask |= 1 << idx
+    return mask
+
+def membership_from_masks(masks) -> np.ndarray:
+    """Expand protocol bitmasks into an (N, P) 0/1 membership matrix"""
+    masks = np.asarray(masks, dtype=np.int64)
+    return ((masks[:, None] >> _PROTOCOL_BITS) & 1).astype(np.float64)
+
+def protocol_membership(protocol_lists: List[List[str]]) -> np.ndarray:
+    """(N, P) membership matrix for a list of per-packet protocol lists"""
+    return membership_from_masks([protocol_mask(protocols) for protocols in protocol_lists])
+
+def get_optimized_sizes(lengths, membership, settings: dict,
+                        rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Batch version of get_optimized_size.
+    `membership` is an (N, P) 0/1 matrix over OPTIMIZATION_PROTOCOLS (see protocol_membership):
+    each protocol present in a packet gets one draw, however many times it appears in the stack.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    lengths = np.asarray(lengths, dtype=np.float64)
+    membership = np.asarray(membership, dtype=np.float64)
+    n = lengths.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    base_low = np.where(lengths < 100, 1.0, np.where(lengths < 500, 10.0, 50.0))
+    base_high = np.where(lengths < 100, 3.0, np.where(lengths < 500, 50.0, 200.0))
+    total_reduction_bytes = rng.uniform(base_low, base_high)
+
+    scale_factor = np.where(lengths >= MIN_COMPRESSIBLE_SIZE, lengths / 1000.0, 0.0)
+    for enabled, ranges in ((settings.get("headerCompression", False), HEADER_REDUCTION_PER_KB),
+                            (settings.get("contentCompression", False), CONTENT_REDUCTION_PER_KB)):
+        if not enabled:
+            continue
+        per_kb = ranges[:, 0] + rng.random((n, ranges.shape[0])) * (ranges[:, 1] - ranges[:, 0])
+        total_reduction_bytes += np.einsum("ij,ij->i", per_kb, membership) * scale_factor
+
+    if settings.get("caching", False):
+        total_reduction_bytes += lengths * rng.uniform(0.02, 0.10, n)
+
+    current_size = np.maximum(0.0, lengths - total_reduction_bytes)
+    min_allowed_size = np.floor(lengths * 0.65 + 0.5)
+    max_allowed_size = np.floor(lengths * 0.90 + 0.5)
+    return np.maximum(min_allowed_size, np.minimum(max_allowed_size, current_size)).astype(np.int64)
+
 if __name__ == "__main__":
     print("--- Test Cases (More Realistic Optimization) ---")
 
@@ -87,4 +153,11 @@ if __name__ == "__main__":
 
     pkt_5 = (MIN_COMPRESSIBLE_SIZE, ["HTTP", "TCP", "IP"], {"headerCompression": True, "contentCompression": True})
     optimized_5 = get_optimized_size(pkt_5[0], pkt_5[1], pkt_5[2])
-    print(f"Original: {pkt_5[0]}, Protocols: {pkt_5[1]}, Settings: {pkt_5[2]}, Optimized: {optimized_5}")
\ No newline at end of file
+    print(f"Original: {pkt_5[0]}, Protocols: {pkt_5[1]}, Settings: {pkt_5[2]}, Optimized: {optimized_5}")
+
+    print("--- Batch version ---")
+    batch = [pkt_1, pkt_2, pkt_3, pkt_4, pkt_5]
+    settings = {"headerCompression": True, "contentCompression": True, "caching": True}
+    sizes = get_optimized_sizes([p[0] for p in batch], protocol_membership([p[1] for p in batch]),
+                                settings, np.random.default_rng(0))
+    print(f"Original: {[p[0] for p in batch]}, Optimized: {sizes.tolist()}")
\ No newline at end of file
@@ -0,0 +1,414 @@
+"""
+Append-only on-disk packet log with a block index, read through memory maps.
+
+A log directory holds segments named by the sequence number of their first packet:
+
+    <seq>.rec          fixed-width records (RECORD_DTYPE), append-only
+    <seq>.idx          per block of BLOCK_RECORDS records: (min ts, max ts)
+    <seq>.bloom        per block: bloom filter over src/dst addresses (BLOOM_BITS bits)
+    <seq>.stacks.json  protocol stacks referenced by the records' `stack` column
+
+Records of a block are only indexed once the block is full (or the segment is closed); readers
+scan the unindexed tail directly. Sequence numbers are global and increase in arrival order,
+which makes them the pagination key: a page returns packets with seq < cursor, newest first.
+"""
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from functools import lru_cache
+import ipaddress
+import json
+import os
+import threading
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RECORD_DTYPE = np.dtype([
+    ("ts", "<f8"), ("src", "S16"), ("dst", "S16"), ("length", "<u4"),
+    ("sport", "<u2"), ("dport", "<u2"), ("stack", "<u2"), ("transport", "u1"), ("flags", "u1"),
+])
+INDEX_DTYPE = np.dtype([("min_ts", "<f8"), ("max_ts", "<f8")])
+BLOCK_RECORDS = 4096
+BLOOM_BITS = 4096
+DEFAULT_SEGMENT_RECORDS = 1 << 20   # ~52 MB на сегмент
+DEFAULT_MAX_SEGMENTS = 32
+MAX_STACKS_PER_SEGMENT = 65535
+
+TRANSPORTS = {"TCP": 6, "UDP": 17}
+TRANSPORT_NAMES = {v: k for k, v in TRANSPORTS.items()}
+TCP_FLAG_BITS = {flag: 1 << i for i, flag in enumerate("FSRPAUEC")}
+
+_SEQ_DIGITS = 16
+_NO_ADDRESS = bytes(16)
+
+
+@lru_cache(maxsize=65536)
+def pack_address(address: Optional[str]) -> bytes:
+    """IPv4/IPv6 address as 16 bytes (IPv4 is stored IPv4-mapped)"""
+    if not address:
+        return _NO_ADDRESS
+    ip = ipaddress.ip_address(address)
+    if ip.version == 4:
+        return b"\x00" * 10 + b"\xff\xff" + ip.packed
+    return ip.packed
+
+
+@lru_cache(maxsize=65536)
+def unpack_address(packed: bytes) -> Optional[str]:
+    packed = packed.ljust(16, b"\x00")  # numpy S16 обрезает нулевые байты в конце
+    if packed == _NO_ADDRESS:
+        return None
+    ip = ipaddress.IPv6Address(packed)
+    return str(ip.ipv4_mapped or ip)
+
+
+def _flag_bits(flags: str) -> int:
+    bits = 0
+    for flag in flags:
+        bits |= TCP_FLAG_BITS.get(flag, 0)
+    return bits
+
+
+def _flag_string(bits: int) -> str:
+    return "".join(flag for flag, bit in TCP_FLAG_BITS.items() if bits & bit)
+
+
+def _address_hashes(addresses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Two bloom bit positions per 16-byte address"""
+    words = np.ascontiguousarray(addresses, dtype="S16").view("<u8").reshape(-1, 2)
+    h = words[:, 0] * np.uint64(0x9E3779B97F4A7C15) + words[:, 1] * np.uint64(0xC2B2AE3D27D4EB4F)
+    h ^= h >> np.uint64(29)
+    return (h % np.uint64(BLOOM_BITS)).astype(np.int64), ((h >> np.uint64(32)) % np.uint64(BLOOM_BITS)).astype(np.int64)
+
+
+def _segment_path(directory: str, start: int, suffix: str) -> str:
+    return os.path.join(directory, f"{start:0{_SEQ_DIGITS}d}{suffix}")
+
+
+def list_segments(directory: str) -> List[int]:
+    """Start sequence numbers of the segments in a log directory, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-4]) for name in os.listdir(directory)
+                  if name.endswith(".rec") and name[:-4].isdigit())
+
+
+def _parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class PacketFilter:
+    """
+    Server-side packet filter parsed from "key=value" terms separated by spaces, e.g.
+    "src=10.0.0.1 dport=443 protocol=TLS since=2026-01-01T12:00:00".
+
+    Keys: src, dst, host (either address), sport, dport, port (either port), transport (tcp/udp),
+    protocol (any layer or application protocol), since/until (ISO time or epoch seconds),
+    min_length, max_length.
+    """
+
+    KEYS = ("src", "dst", "host", "sport", "dport", "port", "transport", "protocol",
+            "since", "until", "min_length", "max_length")
+
+    def __init__(self, **terms):
+        self.src = pack_address(terms["src"]) if terms.get("src") else None
+        self.dst = pack_address(terms["dst"]) if terms.get("dst") else None
+        self.host = pack_address(terms["host"]) if terms.get("host") else None
+        self.sport = int(terms["sport"]) if terms.get("sport") else None
+        self.dport = int(terms["dport"]) if terms.get("dport") else None
+        self.port = int(terms["port"]) if terms.get("port") else None
+        transport = terms.get("transport")
+        self.transport = TRANSPORTS[transport.upper()] if transport else None
+        self.protocol = terms.get("protocol") or None
+        self.since = _parse_time(terms["since"]) if terms.get("since") else None
+        self.until = _parse_time(terms["until"]) if terms.get("until") else None
+        self.min_length = int(terms["min_length"]) if terms.get("min_length") else None
+        self.max_length = int(terms["max_length"]) if terms.get("max_length") else None
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> "PacketFilter":
+        """Raises ValueError on unknown keys or malformed values"""
+        terms = {}
+        for term in (text or "").split():
+            key, sep, value = term.partition("=")
+            if not sep or key not in cls.KEYS:
+                raise ValueError(f"Invalid filter term '{term}', expected one of {', '.join(cls.KEYS)} as key=value")
+            terms[key] = value
+        try:
+            return cls(**terms)
+        except KeyError as e:
+            raise ValueError(f"Unknown transport {e}, expected tcp or udp")
+
+    def addresses(self) -> List[bytes]:
+        """Addresses a matching packet must contain (checked against the block bloom filters)"""
+        return [a for a in (self.src, self.dst, self.host) if a is not None]
+
+    def block_may_match(self, min_ts: float, max_ts: float) -> bool:
+        if self.since is not None and max_ts < self.since:
+            return False
+        if self.until is not None and min_ts > self.until:
+            return False
+        return True
+
+    def mask(self, records: np.ndarray, stacks: List[List[str]]) -> np.ndarray:
+        mask = np.ones(len(records), dtype=bool)
+        if self.src is not None:
+            mask &= records["src"] == self.src
+        if self.dst is not None:
+            mask &= records["dst"] == self.dst
+        if self.host is not None:
+            mask &= (records["src"] == self.host) | (records["dst"] == self.host)
+        if self.sport is not None:
+            mask &= records["sport"] == self.sport
+        if self.dport is not None:
+            mask &= records["dport"] == self.dport
+        if self.port is not None:
+            mask &= (records["sport"] == self.port) | (records["dport"] == self.port)
+        if self.transport is not None:
+            mask &= records["transport"] == self.transport
+        if self.protocol is not None:
+            wanted = [i for i, stack in enumerate(stacks) if self.protocol in stack]
+            mask &= np.isin(records["stack"], wanted)
+        if self.since is not None:
+            mask &= records["ts"] >= self.since
+        if self.until is not None:
+            mask &= records["ts"] <= self.until
+        if self.min_length is not None:
+            mask &= records["length"] >= self.min_length
+        if self.max_length is not None:
+            mask &= records["length"] <= self.max_length
+        return mask
+
+
+class PacketLogWriter:
+    """Appends packet dicts (packet_to_dict format) to the log; one writer per directory"""
+
+    def __init__(self, directory: str, segment_records: int = DEFAULT_SEGMENT_RECORDS,
+                 max_segments: int = DEFAULT_MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # продолжаем нумерацию после существующих сегментов, но пишем в новый
+        segments = list_segments(directory)
+        self.next_seq = 0
+        if segments:
+            last = segments[-1]
+            self.next_seq = last + os.path.getsize(_segment_path(directory, last, ".rec")) // RECORD_DTYPE.itemsize
+        self._segment_start = None
+        self._files = None
+        self._count = 0
+        self._stacks: List[Tuple[str, ...]] = []
+        self._stack_ids: Dict[Tuple[str, ...], int] = {}
+        self._reset_block()
+
+    def _reset_block(self):
+        self._block_min = np.inf
+        self._block_max = -np.inf
+        self._block_bits = np.zeros(BLOOM_BITS, dtype=bool)
+        self._block_count = 0
+
+    def _open_segment(self):
+        self._segment_start = self.next_seq
+        self._files = tuple(open(_segment_path(self.directory, self._segment_start, suffix), "ab")
+                            for suffix in (".rec", ".idx", ".bloom"))
+        self._count = 0
+        self._stacks = []
+        self._stack_ids = {}
+        self._write_stacks()
+        self._reset_block()
+        self._apply_retention()
+
+    def _close_segment(self):
+        if self._files is None:
+            return
+        if self._block_count:
+            self._flush_block()
+        for f in self._files:
+            f.close()
+        self._files = None
+
+    def _write_stacks(self):
+        path = _segment_path(self.directory, self._segment_start, ".stacks.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([list(stack) for stack in self._stacks], f)
+        os.replace(tmp_path, path)
+
+    def _flush_block(self):
+        _, idx_file, bloom_file = self._files
+        # bloom пишем раньше индекса: читатель берет число блоков из .idx и не опередит .bloom
+        bloom_file.write(np.packbits(self._block_bits).tobytes())
+        bloom_file.flush()
+        idx_file.write(np.array([(self._block_min, self._block_max)], dtype=INDEX_DTYPE).tobytes())
+        idx_file.flush()
+        self._reset_block()
+
+    def _apply_retention(self):
+        segments = list_segments(self.directory)
+        for start in segments[:max(0, len(segments) - self.max_segments)]:
+            for suffix in (".rec", ".idx", ".bloom", ".stacks.json"):
+                try:
+                    os.remove(_segment_path(self.directory, start, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def _to_records(self, packets: List[Dict]) -> np.ndarray:
+        rows = []
+        new_stacks = False
+        for p in packets:
+            stack = tuple(p.get("protocols", ()))
+            stack_id = self._stack_ids.get(stack)
+            if stack_id is None:
+                stack_id = min(len(self._stacks), MAX_STACKS_PER_SEGMENT)
+                if stack_id < MAX_STACKS_PER_SEGMENT:
+                    self._stack_ids[stack] = stack_id
+                    self._stacks.append(stack)
+                    new_stacks = True
+            info = p.get("tcp_info") or p.get("udp_info") or {}
+            transport = TRANSPORTS["TCP"] if "tcp_info" in p else TRANSPORTS["UDP"] if "udp_info" in p else 0
+            rows.append((
+                datetime.fromisoformat(p["timestamp"]).timestamp(),
+                pack_address(p.get("src")), pack_address(p.get("dst")), p.get("length", 0),
+                info.get("sport", 0), info.get("dport", 0), stack_id, transport,
+                _flag_bits(info.get("flags", "")),
+            ))
+        if new_stacks:
+            # таблицу стеков пишем до записей, которые на нее ссылаются
+            self._write_stacks()
+        return np.array(rows, dtype=RECORD_DTYPE)
+
+    def append(self, packets: List[Dict]):
+        """Append a batch; rotates segments and writes index blocks as they fill up"""
+        with self._lock:
+            while packets:
+                if self._files is None or self._count >= self.segment_records:
+                    self._close_segment()
+                    self._open_segment()
+                take = min(len(packets), self.segment_records - self._count)
+                records = self._to_records(packets[:take])
+                packets = packets[take:]
+                self._files[0].write(records.tobytes())
+                self._files[0].flush()
+                self._index(records)
+                self._count += take
+                self.next_seq += take
+
+    def _index(self, records: np.ndarray):
+        src_hashes = _address_hashes(records["src"])
+        dst_hashes = _address_hashes(records["dst"])
+        ts = records["ts"]
+        start = 0
+        while start < len(records):
+            end = min(len(records), start + BLOCK_RECORDS - self._block_count)
+            self._block_min = min(self._block_min, float(ts[start:end].min()))
+            self._block_max = max(self._block_max, float(ts[start:end].max()))
+            for positions in (*src_hashes, *dst_hashes):
+                self._block_bits[positions[start:end]] = True
+            self._block_count += end - start
+            if self._block_count >= BLOCK_RECORDS:
+                self._flush_block()
+            start = end
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+class PacketLogReader:
+    """Queries a packet log directory; safe to use while a writer (in any process) appends"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._stacks_cache: Dict[int, Tuple[int, List[List[str]]]] = {}
+
+    def _stacks(self, start: int) -> List[List[str]]:
+        path = _segment_path(self.directory, start, ".stacks.json")
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._stacks_cache.get(start)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                cached = self._stacks_cache[start] = (mtime, json.load(f))
+        return cached[1]
+
+    @staticmethod
+    def _map(path: str, dtype: np.dtype, count: int) -> np.ndarray:
+        if count <= 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+    def query(self, packet_filter: PacketFilter, cursor: Optional[int] = None,
+              limit: int = 100) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Newest-first page of packets matching the filter with seq < cursor.
+        Returns (packets, next_cursor); next_cursor is None when there is nothing older.
+        """
+        results: List[Dict] = []
+        addresses = packet_filter.addresses()
+        address_bits = [tuple(int(h[0]) for h in _address_hashes(np.array([a], dtype="S16"))) for a in addresses]
+        segments = list_segments(self.directory)
+
+        for start in reversed(segments):
+            if cursor is not None and start >= cursor:
+                continue
+            try:
+                n = os.path.getsize(_segment_path(self.directory, start, ".rec")) // RECORD_DTYPE.itemsize
+                # блоков столько, сколько записано и в .idx, и в .bloom (запрос мог попасть между записями)
+                n_indexed = min(os.path.getsize(_segment_path(self.directory, start, ".idx")) // INDEX_DTYPE.itemsize,
+                                os.path.getsize(_segment_path(self.directory, start, ".bloom")) // (BLOOM_BITS // 8))
+                stacks = self._stacks(start)
+            except FileNotFoundError:  # сегмент удален по retention во время запроса
+                continue
+            end = n if cursor is None else min(n, cursor - start)
+            if end <= 0:
+                continue
+            n_indexed = min(n_indexed, -(-n // BLOCK_RECORDS))
+            records = self._map(_segment_path(self.directory, start, ".rec"), RECORD_DTYPE, n)
+            index = self._map(_segment_path(self.directory, start, ".idx"), INDEX_DTYPE, n_indexed)
+            blooms = self._map(_segment_path(self.directory, start, ".bloom"),
+                               np.dtype((np.uint8, BLOOM_BITS // 8)), n_indexed)
+
+            for block in range((end - 1) // BLOCK_RECORDS, -1, -1):
+                lo = block * BLOCK_RECORDS
+                hi = min(lo + BLOCK_RECORDS, end)
+                if block < n_indexed:
+                    if not packet_filter.block_may_match(index[block]["min_ts"], index[block]["max_ts"]):
+                        continue
+                    if address_bits:
+                        bits = np.unpackbits(blooms[block])
+                        if not all(bits[h1] and bits[h2] for h1, h2 in address_bits):
+                            continue
+                chunk = records[lo:hi]
+                hits = np.flatnonzero(packet_filter.mask(chunk, stacks))[::-1]
+                for i in hits[:limit - len(results)]:
+                    results.append(self._to_dict(start + lo + int(i), chunk[i], stacks))
+                if len(results) >= limit:
+                    return results, results[-1]["id"]
+        return results, None
+
+    @staticmethod
+    def _to_dict(seq: int, record, stacks: List[List[str]]) -> Dict:
+        transport = TRANSPORT_NAMES.get(int(record["transport"]))
+        stack = int(record["stack"])
+        packet = {
+            "id": seq,
+            "timestamp": datetime.fromtimestamp(float(record["ts"])).isoformat(),
+            "src": unpack_address(bytes(record["src"])),
+            "dst": unpack_address(bytes(record["dst"])),
+            "length": int(record["length"]),
+            "protocols": stacks[stack] if stack < len(stacks) else [],
+            "transport": transport,
+        }
+        if transport is not None:
+            packet["sport"] = int(record["sport"])
+            packet["dport"] = int(record["dport"])
+        if transport == "TCP":
+            packet["flags"] = _flag_string(int(record["flags"]))
+        return packet
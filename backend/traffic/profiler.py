@@ -0,0 +1,98 @@
+from typing import Dict, List
+from collections import Counter
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Кадры, в которых поток обычно просто ждет (очередь, select, lock) - отбрасываются при include_idle=False
+IDLE_FUNCTIONS = {"wait", "select", "poll", "_poll", "acquire", "_wait_for_tstate_lock", "recv_bytes", "_recv", "accept"}
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Another profiling session is already running"""
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005, include_idle: bool = False) -> Counter:
+    """
+    Sample the Python stacks of all threads every `interval` seconds for `seconds`.
+    Returns a Counter of collapsed stacks ("thread;outer;...;inner") -> number of samples.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("Profiler is already running")
+    try:
+        own_thread = threading.get_ident()
+        thread_names: Dict[int, str] = {}
+        labels: Dict[object, str] = {}  # кэш подписи по code object
+        samples: Counter = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names.update({t.ident: t.name for t in threading.enumerate()})
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, f"thread-{thread_id}"))
+                samples[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return samples
+    finally:
+        _profile_lock.release()
+
+
+def collapsed_stacks(samples: Counter) -> str:
+    """Brendan Gregg's collapsed format, consumable by flamegraph.pl / speedscope"""
+    return "\n".join(f"{stack} {count}" for stack, count in samples.most_common()) + "\n"
+
+
+def memory_diff(seconds: float, top: int = 25, frames: int = 1) -> List[Dict]:
+    """
+    Allocations that appeared during `seconds` and are still alive, grouped by source line.
+    Starts tracemalloc for the duration of the call if it is not already tracing.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("Profiler is already running")
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start(frames)
+        ignore = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, __file__),
+        )
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        key = "lineno" if frames <= 1 else "traceback"
+        return [
+            {
+                "location": [str(frame) for frame in stat.traceback],
+                "size_diff": stat.size_diff,
+                "size": stat.size,
+                "count_diff": stat.count_diff,
+                "count": stat.count,
+            }
+            for stat in after.compare_to(before, key)[:top]
+        ]
+    finally:
+        if started:
+            tracemalloc.stop()
+        _profile_lock.release()
@@ -0,0 +1,45 @@
+from typing import Dict, Iterable, List, Tuple
+import threading
+
+from traffic.optimizer_logs import protocol_mask
+
+
+class ProtocolStackRegistry:
+    """
+    Interns protocol stacks (tuples of layer names) into small integer ids, so the hot stages
+    hash one tuple per packet and then work with ints and per-id precomputed data.
+    """
+
+    def __init__(self):
+        self._ids: Dict[Tuple[str, ...], int] = {}
+        self.stacks: List[Tuple[str, ...]] = []
+        self.masks: List[int] = []  # битовая маска протоколов optimizer_logs для каждого стека
+        self._lock = threading.Lock()
+
+    def intern(self, protocols: Iterable[str]) -> int:
+        stack = tuple(protocols)
+        stack_id = self._ids.get(stack)
+        if stack_id is None:
+            with self._lock:
+                stack_id = self._ids.get(stack)
+                if stack_id is None:
+                    # сначала заполняем списки, потом публикуем id
+                    self.stacks.append(stack)
+                    self.masks.append(protocol_mask(stack))
+                    stack_id = len(self.stacks) - 1
+                    self._ids[stack] = stack_id
+        return stack_id
+
+    def __len__(self):
+        return len(self.stacks)
+
+
+STACKS = ProtocolStackRegistry()
+
+
+def stack_id_of(packet: Dict) -> int:
+    """Interned stack id of a packet dict, assigned on first use"""
+    stack_id = packet.get("stack_id")
+    if stack_id is None:
+        stack_id = packet["stack_id"] = STACKS.intern(packet.get("protocols", ()))
+    return stack_id
@@ -0,0 +1,328 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import threading
+import time
+
+import numpy as np
+
+from traffic.optimizer import TrafficOptimizer
+from traffic.protocols import STACKS
+
+DEFAULT_LINK_CAPACITY = 12_500_000  # bytes/s (100 Mbit/s)
+DEFAULT_BUFFER_BYTES = 256 * 1024   # размер очереди каждого класса
+DEFAULT_TICK = 0.01                 # шаг симуляции, секунды
+MAX_SIMULATED_TICKS = 2_000_000     # предел непустых тиков на один прогон
+MAX_SIMULATION_SPAN = 24 * 3600     # предел длительности трассы для API, секунды
+MAX_RULE_SETS = 8
+
+
+class TrafficTrace:
+    """
+    Columnar packet trace used by the simulator.
+    Protocol stacks are stored once in `stacks`; each packet refers to one by index.
+    """
+
+    def __init__(self, times: np.ndarray, lengths: np.ndarray, stack_ids: np.ndarray,
+                 stacks: List[Tuple[str, ...]]):
+        order = np.argsort(times, kind="stable")
+        self.times = np.asarray(times, dtype=np.float64)[order]
+        self.lengths = np.asarray(lengths, dtype=np.float64)[order]
+        self.stack_ids = np.asarray(stack_ids, dtype=np.int64)[order]
+        self.stacks = stacks
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self) -> float:
+        return float(self.times[-1] - self.times[0]) if len(self.times) > 1 else 0.0
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[float, int, Tuple[str, ...]]]) -> "TrafficTrace":
+        """Build a trace from (unix time, length, protocol stack) tuples"""
+        stack_index: Dict[Tuple[str, ...], int] = {}
+        times, lengths, stack_ids = [], [], []
+        for ts, length, stack in records:
+            times.append(ts)
+            lengths.append(length)
+            stack_ids.append(stack_index.setdefault(stack, len(stack_index)))
+        return cls(np.array(times, dtype=np.float64), np.array(lengths, dtype=np.float64),
+                   np.array(stack_ids, dtype=np.int64), list(stack_index))
+
+    @classmethod
+    def from_packets(cls, packets: Iterable[Dict]) -> "TrafficTrace":
+        """Build a trace from packet dicts produced by packet_to_dict"""
+        return cls.from_records(
+            (datetime.fromisoformat(p["timestamp"]).timestamp(), p.get("length", 0), tuple(p.get("protocols", [])))
+            for p in packets
+        )
+
+    @classmethod
+    def from_pcap(cls, path: str, limit: Optional[int] = None) -> "TrafficTrace":
+        """Read a pcap file (dissected with scapy, so this is the slow part)"""
+        from scapy.utils import PcapReader
+
+        def records():
+            with PcapReader(path) as reader:
+                for i, pkt in enumerate(reader):
+                    if limit is not None and i >= limit:
+                        break
+                    layers = []
+                    current = pkt
+                    while current:
+                        layers.append(current.name)
+                        current = current.payload
+                    yield float(pkt.time), len(pkt), tuple(layers)
+
+        return cls.from_records(records())
+
+
+class TrafficWindow:
+    """Bounded in-memory record of recent traffic that can be replayed by the simulator"""
+
+    def __init__(self, max_packets: int = 1_000_000):
+        self.records = deque(maxlen=max_packets)
+        self._lock = threading.Lock()
+
+    def add_packets(self, packets: List[Dict]):
+        rows = [
+            (datetime.fromisoformat(p["timestamp"]).timestamp(), p.get("length", 0), tuple(p.get("protocols", [])))
+            for p in packets
+        ]
+        with self._lock:
+            self.records.extend(rows)
+
+    def trace(self, seconds: Optional[float] = None) -> TrafficTrace:
+        """Trace of the last `seconds` of recorded traffic (everything if None)"""
+        with self._lock:
+            records = list(self.records)
+        if seconds is not None and records:
+            start = records[-1][0] - seconds
+            records = [r for r in records if r[0] >= start]
+        return TrafficTrace.from_records(records)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+    def export_state(self) -> Tuple[Dict, Dict[str, np.ndarray]]:
+        """Recorded traffic as columns for a state snapshot"""
+        with self._lock:
+            records = list(self.records)
+        arrays = {
+            "times": np.array([r[0] for r in records], dtype=np.float64),
+            "lengths": np.array([r[1] for r in records], dtype=np.int32),
+            "stack_ids": np.array([STACKS.intern(r[2]) for r in records], dtype=np.int32),
+        }
+        return {}, arrays
+
+    def restore_state(self, meta: Dict, arrays: Dict[str, np.ndarray], since: Optional[float] = None):
+        """
+        Prepend traffic from a state snapshot (older than anything recorded since start).
+        Records before `since` are dropped so the trace does not stretch over the downtime.
+        """
+        if "times" not in arrays:
+            return
+        times = arrays["times"]
+        keep = slice(None) if since is None else times >= since
+        stacks = STACKS.stacks
+        restored = zip(times[keep].tolist(), arrays["lengths"][keep].tolist(),
+                       [stacks[i] for i in arrays["stack_ids"][keep].tolist()])
+        with self._lock:
+            current = list(self.records)
+            self.records.clear()
+            self.records.extend(restored)
+            self.records.extend(current)
+
+
+def _rules_optimizer(rules: Dict[str, Dict]) -> TrafficOptimizer:
+    optimizer = TrafficOptimizer()
+    for protocol, rule in rules.items():
+        optimizer.set_qos_rule(protocol, rule.get("priority", 0), rule.get("bandwidth_limit"))
+    return optimizer
+
+
+def simulate_qos(trace: TrafficTrace, rules: Dict[str, Dict],
+                 link_capacity: float = DEFAULT_LINK_CAPACITY,
+                 buffer_bytes: float = DEFAULT_BUFFER_BYTES,
+                 tick: float = DEFAULT_TICK, max_ticks: int = MAX_SIMULATED_TICKS) -> Dict:
+    """
+    Replay a trace through a strict-priority link shaped by the given QoS rules.
+
+    Packets are classified like TrafficOptimizer does (highest-priority rule among the layers);
+    each class has a FIFO queue of `buffer_bytes` with tail drop and, if the rule has a
+    bandwidth_limit, a token bucket at that rate (bytes/s). The link serves `link_capacity`
+    bytes/s to classes in priority order. Time advances in fixed ticks, but only ticks with
+    arrivals or non-empty queues are simulated (at most `max_ticks`; the result is then marked
+    "truncated" and the rest counts as queued). Per-packet work is vectorized.
+    """
+    started = time.perf_counter()
+    rule_optimizer = _rules_optimizer(rules)
+
+    # классы: по стеку протоколов -> класс правил
+    class_index: Dict[str, int] = {}
+    class_info: List[Dict] = []
+    stack_class = np.zeros(max(len(trace.stacks), 1), dtype=np.int64)
+    for stack_id, stack in enumerate(trace.stacks):
+        traffic_class = rule_optimizer.get_traffic_class(list(stack))
+        if traffic_class["name"] not in class_index:
+            class_index[traffic_class["name"]] = len(class_info)
+            class_info.append(traffic_class)
+        stack_class[stack_id] = class_index[traffic_class["name"]]
+
+    n_packets = len(trace)
+    if n_packets == 0:
+        return {"classes": {}, "total": {"packets": 0}, "duration": 0.0, "sim_seconds": 0.0}
+
+    n_classes = len(class_info)
+    rel_times = trace.times - trace.times[0]
+    packet_tick = (rel_times / tick).astype(np.int64)
+    span_ticks = int(packet_tick[-1]) + 1
+
+    # группы (тик, класс) только там, где есть пакеты; внутри группы пакеты в порядке прихода
+    group = packet_tick * n_classes + stack_class[trace.stack_ids]
+    by_group = np.argsort(group, kind="stable")
+    group = group[by_group]
+    lengths = trace.lengths[by_group]
+    cum = np.cumsum(lengths)
+    group_first = np.r_[True, group[1:] != group[:-1]]
+    within_group = cum - np.maximum.accumulate(np.where(group_first, cum - lengths, 0.0))
+    group_start = np.flatnonzero(group_first)
+    packet_group = np.cumsum(group_first) - 1  # номер непустой группы пакета
+    group_key = group[group_start]
+    group_bounds = np.r_[group_start, n_packets].tolist()
+    group_tick = (group_key // n_classes).tolist()
+    group_class = (group_key % n_classes).tolist()
+    arrivals = np.add.reduceat(lengths, group_start).tolist()
+    within_list = within_group.tolist()
+    n_groups = len(group_start)
+
+    order = sorted(range(n_classes), key=lambda c: class_info[c]["priority"], reverse=True)
+    rates = [class_info[c]["bandwidth_limit"] or None for c in range(n_classes)]
+    bursts = [max(r * tick, 1500.0) if r else None for r in rates]
+    tokens = [b or 0.0 for b in bursts]
+    backlog = [0.0] * n_classes
+    admitted_bytes = [0.0] * n_groups
+    # обслуженные байты храним только на тиках, где они менялись: (тик, накопленная сумма)
+    served_ticks = [[] for _ in range(n_classes)]
+    served_cum = [[] for _ in range(n_classes)]
+    served_total = [0.0] * n_classes
+    link_per_tick = link_capacity * tick
+    eps = 1e-6
+
+    # событийный цикл: тики без пакетов и с пустыми очередями пропускаются целиком,
+    # поэтому стоимость зависит от числа пакетов и длины очередей, а не от длительности трассы
+    t = 0
+    gi = 0
+    simulated_ticks = 0
+    truncated = False
+    while gi < n_groups or any(b > eps for b in backlog):
+        if gi < n_groups and group_tick[gi] > t and not any(b > eps for b in backlog):
+            idle = group_tick[gi] - t
+            for c in range(n_classes):
+                if rates[c]:
+                    tokens[c] = min(tokens[c] + rates[c] * tick * idle, bursts[c])
+            t = group_tick[gi]
+        if simulated_ticks >= max_ticks:
+            truncated = True
+            break
+        while gi < n_groups and group_tick[gi] == t:
+            c = group_class[gi]
+            admitted = arrivals[gi]
+            space = buffer_bytes - backlog[c]
+            if admitted > space:
+                # tail drop: принимаем только целые пакеты, которые помещаются в очередь
+                lo, hi = group_bounds[gi], group_bounds[gi + 1]
+                idx = bisect_right(within_list, space + eps, lo, hi)
+                admitted = within_list[idx - 1] if idx > lo else 0.0
+            admitted_bytes[gi] = admitted
+            backlog[c] += admitted
+            gi += 1
+
+        capacity = link_per_tick
+        for c in order:
+            serve = backlog[c] if backlog[c] < capacity else capacity
+            if rates[c]:
+                tokens[c] = min(tokens[c] + rates[c] * tick, bursts[c])
+                if serve > tokens[c]:
+                    serve = tokens[c]
+                tokens[c] -= serve
+            if serve > 0:
+                backlog[c] -= serve
+                capacity -= serve
+                served_total[c] += serve
+                served_ticks[c].append(t)
+                served_cum[c].append(served_total[c])
+        t += 1
+        simulated_ticks += 1
+
+    admitted_bytes = np.asarray(admitted_bytes)
+    kept = within_group <= admitted_bytes[packet_group] + eps
+    packet_class = group % n_classes
+    packet_times = rel_times[by_group]
+    # пропускная способность - только по байтам, ушедшим в пределах самой трассы (без дослива очередей)
+    duration = span_ticks * tick
+    report_classes = {}
+    for c, info in enumerate(class_info):
+        mask = packet_class == c
+        class_kept = kept[mask]
+
+        # FIFO: пакет уходит, когда суммарно обслуженные байты класса достигают его позиции в очереди
+        class_groups = np.flatnonzero(np.asarray(group_class) == c)
+        admitted_before = np.zeros(n_groups)
+        admitted_before[class_groups] = np.cumsum(admitted_bytes[class_groups]) - admitted_bytes[class_groups]
+        position = (admitted_before[packet_group[mask]] + within_group[mask])[class_kept]
+        served = np.asarray(served_cum[c])
+        depart_index = np.searchsorted(served, position - eps, side="left")
+        delivered = depart_index < len(served)
+        depart_tick = np.asarray(served_ticks[c], dtype=np.int64)[depart_index[delivered]]
+        delays = np.maximum((depart_tick + 1) * tick - packet_times[mask][class_kept][delivered], 0.0)
+
+        n_total = int(mask.sum())
+        n_kept = int(class_kept.sum())
+        n_delivered = int(delivered.sum())
+        delivered_lengths = lengths[mask][class_kept][delivered]
+        report_classes[info["name"]] = {
+            "priority": info["priority"],
+            "bandwidth_limit": info["bandwidth_limit"],
+            "packets": n_total,
+            "bytes": float(lengths[mask].sum()),
+            "delivered_packets": n_delivered,
+            "dropped_packets": n_total - n_kept,
+            "queued_packets": n_kept - n_delivered,
+            "drop_rate": (n_total - n_kept) / n_total if n_total else 0.0,
+            "throughput": float(delivered_lengths[depart_tick < span_ticks].sum()) / duration,
+            "avg_queue_delay": float(delays.mean()) if delays.size else 0.0,
+            "p95_queue_delay": float(np.percentile(delays, 95)) if delays.size else 0.0,
+            "max_queue_delay": float(delays.max()) if delays.size else 0.0,
+        }
+
+    sim_seconds = time.perf_counter() - started
+    dropped = sum(c["dropped_packets"] for c in report_classes.values())
+    return {
+        "classes": report_classes,
+        "total": {
+            "packets": n_packets,
+            "bytes": float(trace.lengths.sum()),
+            "dropped_packets": dropped,
+            "drop_rate": dropped / n_packets,
+            "throughput": sum(c["throughput"] for c in report_classes.values()),
+        },
+        "duration": trace.duration,
+        "truncated": truncated,
+        "sim_seconds": sim_seconds,
+        "packets_per_second": n_packets / sim_seconds if sim_seconds > 0 else None,
+    }
+
+
+def simulate_rule_sets(trace: TrafficTrace, rule_sets: List[Dict[str, Dict]],
+                       max_workers: Optional[int] = None, **kwargs) -> List[Dict]:
+    """Evaluate several candidate rule sets against the same trace, one process per rule set"""
+    if len(rule_sets) <= 1:
+        return [simulate_qos(trace, rules, **kwargs) for rules in rule_sets]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(simulate_qos, trace, rules, **kwargs) for rules in rule_sets]
+        return [f.result() for f in futures]
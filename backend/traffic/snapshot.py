@@ -0,0 +1,97 @@
+from typing import Dict, Optional, Tuple
+import json
+import mmap
+import os
+import struct
+import time
+import logging
+
+import numpy as np
+
+from traffic.protocols import STACKS
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"NTSNAP\x00\x01"
+_HEADER_LENGTH = struct.Struct("<Q")
+_ALIGN = 8
+
+# Массивы с id стеков (STACKS) хранятся с таблицей стеков в заголовке и при загрузке
+# переводятся в id текущего процесса. Признак - имя массива оканчивается на этот суффикс.
+STACK_ID_SUFFIX = "stack_ids"
+
+
+def write_snapshot(path: str, sections: Dict, arrays: Dict[str, np.ndarray]):
+    """
+    Write a snapshot: magic, JSON header (sections, stack table, array layout),
+    then the raw arrays, each 8-byte aligned. The file is replaced atomically.
+    """
+    layout = []
+    offset = 0
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    for name, array in arrays.items():
+        layout.append({"name": name, "dtype": array.dtype.str, "length": int(array.size), "offset": offset})
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({
+        "created_at": time.time(),
+        "stacks": [list(stack) for stack in STACKS.stacks],
+        "sections": sections,
+        "arrays": layout,
+    }, separators=(",", ":")).encode()
+    data_start = -(-(len(SNAPSHOT_MAGIC) + _HEADER_LENGTH.size + len(header)) // _ALIGN) * _ALIGN
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # несколько API-воркеров пишут один путь
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        for entry, array in zip(layout, arrays.values()):
+            f.seek(data_start + entry["offset"])
+            f.write(memoryview(array).cast("B"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Optional[Tuple[Dict, Dict[str, np.ndarray]]]:
+    """
+    Memory-map a snapshot and return (header, arrays); arrays are read-only views into the map.
+    Returns None if the file is missing or not a snapshot.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # пустой файл
+            return None
+    if buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        logger.warning(f"{path} is not a traffic snapshot, ignoring")
+        return None
+    (header_length,) = _HEADER_LENGTH.unpack_from(buffer, len(SNAPSHOT_MAGIC))
+    header_start = len(SNAPSHOT_MAGIC) + _HEADER_LENGTH.size
+    header = json.loads(buffer[header_start:header_start + header_length])
+    data_start = -(-(header_start + header_length) // _ALIGN) * _ALIGN
+
+    # id стеков из файла -> id в текущем реестре
+    remap = np.array([STACKS.intern(stack) for stack in header["stacks"]] or [0], dtype=np.int64)
+    arrays = {}
+    for entry in header["arrays"]:
+        array = np.frombuffer(buffer, dtype=np.dtype(entry["dtype"]), count=entry["length"],
+                              offset=data_start + entry["offset"])
+        if entry["name"].endswith(STACK_ID_SUFFIX):
+            array = remap[array]
+        arrays[entry["name"]] = array
+    return header, arrays
+
+
+def split_arrays(arrays: Dict[str, np.ndarray], prefix: str) -> Dict[str, np.ndarray]:
+    """Arrays of one component ("<prefix>.<name>"), keyed by <name>"""
+    start = len(prefix) + 1
+    return {name[start:]: array for name, array in arrays.items() if name.startswith(prefix + ".")}
+
+
+def join_arrays(prefix: str, arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    return {f"{prefix}.{name}": array for name, array in arrays.items()}
@@ -1,35 +1,98 @@
 from scapy.all import sniff, conf, IFACES
-from typing import Callable
+from typing import Callable, Optional
+from datetime import datetime
 import time
 import threading
 from concurrent.futures import ThreadPoolExecutor
 import queue
 from scapy.layers.inet import IP, TCP, UDP
+from scapy.packet import Packet, Padding, Raw
 import logging
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def sniff_interface(interface_name: str, callback: Callable):
+def sniff_interface(interface_name: Optional[str], callback: Callable, bpf_filter: Optional[str] = None,
+                    stop_event=None, retry_delay: float = 1.0, offline: Optional[str] = None):
+    """
+    Capture on a single interface, restarting the capture after errors.
+    With `offline` set the packets are read once from that pcap file instead.
+    """
+    if offline:
+        sniff(offline=offline, prn=callback, filter=bpf_filter, store=0)
+        return
+
     def process_packet(packet):
         try:
-            print(f"📦 Got packet from {interface_name}: {packet.summary()}")
             callback(packet)
         except Exception as e:
             print(f"Error processing packet on {interface_name}: {e}")
 
+    while stop_event is None or not stop_event.is_set():
+        try:
+            print(f"\nНачинаем захват пакетов на интерфейсе {interface_name}...")
+            sniff(iface=interface_name,
+                  prn=process_packet,
+                  filter=bpf_filter,
+                  store=0,
+                  count=0,
+                  stop_filter=(lambda _: stop_event.is_set()) if stop_event else None)
+            return
+        except Exception as e:
+            print(f"Ошибка сниффера на интерфейсе {interface_name}: {e}")
+            # Перезапускаем захват на этом интерфейсе
+            time.sleep(retry_delay)
+
+def packet_to_dict(pkt: Packet) -> Optional[dict]:
+    """Convert Scapy packet to dictionary format"""
     try:
-        print(f"\nНачинаем захват пакетов на интерфейсе {interface_name}...")
-        sniff(iface=interface_name,
-              prn=process_packet,
-              store=0,
-              count=0)  
+        layers = []
+        current = pkt
+        while current:
+            layers.append(current.name)
+            current = current.payload
+
+        packet_dict = {
+            "src": pkt[IP].src if IP in pkt else None,
+            "dst": pkt[IP].dst if IP in pkt else None,
+            "protocols": layers,
+            "length": len(pkt),
+            "timestamp": datetime.fromtimestamp(float(pkt.time)).isoformat(),
+            "summary": pkt.summary()
+        }
+
+        if TCP in pkt:
+            packet_dict["tcp_info"] = {
+                "sport": pkt[TCP].sport,
+                "dport": pkt[TCP].dport,
+                "flags": str(pkt[TCP].flags),
+                "window": pkt[TCP].window
+            }
+        if UDP in pkt:
+            packet_dict["udp_info"] = {
+                "sport": pkt[UDP].sport,
+                "dport": pkt[UDP].dport,
+                "len": pkt[UDP].len
+            }
+        return packet_dict
     except Exception as e:
-        print(f"Ошибка сниффера на интерфейсе {interface_name}: {e}")
-        time.sleep(1)
-        # Перезапускаем захват на этом интерфейсе
-        sniff_interface(interface_name, callback)
+        print(f" Error converting packet: {e}")
+        return None
+
+def payload_prefix(pkt: Packet, size: int) -> bytes:
+    """First `size` bytes of the TCP/UDP payload; Ethernet padding is not payload"""
+    layer = pkt[TCP].payload if TCP in pkt else pkt[UDP].payload if UDP in pkt else None
+    if not layer or isinstance(layer, Padding):
+        return b""
+    if isinstance(layer, Raw):
+        return bytes(layer.load[:size])
+    # scapy разобрал прикладной уровень (DNS и т.п.) - собираем байты без хвостового Padding
+    data = bytes(layer)
+    padding = layer.getlayer(Padding)
+    if padding is not None:
+        data = data[:len(data) - len(padding.load)]
+    return data[:size]
 
 def start_sniffing(callback: Callable, interface: str = None):
     """Start packet sniffing with given callback"""
@@ -71,7 +134,7 @@ class PacketSniffer:
         """Start packet capture"""
         self.running = True
         
-        self.worker_thread = threading.Thread(target=self.process_packets)
+        self.worker_thread = threading.Thread(target=self.process_packets, name="packet-sniffer-worker")
         self.worker_thread.daemon = True
         self.worker_thread.start()
         